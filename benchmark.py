@@ -0,0 +1,393 @@
+"""Benchmark & uji beban bot tanpa jaringan.
+
+Aplikasi Flask dijalankan apa adanya, tetapi Telegram, Binance, ER-API dan Polygon
+diarahkan ke server HTTP tiruan lokal (lewat *_API_BASE), dan Google Sheets diganti
+spreadsheet tiruan di memori berisi ledger sintetis per pengguna. Setiap ukuran ledger
+diukur di proses terpisah agar peak RSS dan cache tidak saling memengaruhi.
+
+Contoh:
+    python benchmark.py
+    python benchmark.py --rows 10,1000,100000 --iterations 30
+    python benchmark.py --rows 5000 --burst 500 --burst-chats 50 --burst-command status
+    python benchmark.py --rows 1000 --users 200 --commands status   # termasuk waktu snapshot harian
+    python benchmark.py --json > hasil.json   # untuk dibandingkan antar versi
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+DEFAULT_ROWS = "10,1000,100000"
+DEFAULT_COMMANDS = "cek harga,status,grafik,cek volatilitas,prediksi,dca 100000"
+BENCH_TOKEN = "bench"
+BENCH_CHAT_ID = 1
+BTC_USDT = 65000.0
+USD_IDR = 16000.0
+
+# ==============================================================================
+# Layanan tiruan
+# ==============================================================================
+
+class StubUpstream(BaseHTTPRequestHandler):
+    """Meniru endpoint Telegram, Binance, ER-API dan Polygon yang dipakai bot."""
+    latency = 0.0
+    counts = {}
+    _lock = threading.Lock()
+    protocol_version = "HTTP/1.1"  # keep-alive, seperti layanan aslinya
+    wbufsize = 65536  # header & body dikirim dalam satu paket (menghindari jeda delayed-ACK)
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _count(self, path):
+        nama = re.sub(r"/bot[^/]+/", "/bot<token>/", path)
+        nama = re.sub(r"/range/1/day/.*", "/range/...", nama)
+        with self._lock:
+            self.counts[nama] = self.counts.get(nama, 0) + 1
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self._count(url.path)
+        time.sleep(self.latency)
+        if url.path == "/api/v3/ticker/price":
+            return self._reply({"symbol": "BTCUSDT", "price": f"{BTC_USDT:.2f}"})
+        if url.path == "/v6/latest/USD":
+            return self._reply({"result": "success", "rates": {"IDR": USD_IDR}})
+        if url.path == "/api/v3/klines":
+            mulai, sampai = int(query["startTime"]), int(query["endTime"])
+            hari = range(mulai, sampai + 1, 86400000)
+            return self._reply([[t, *_synthetic_ohlc(t)] for t in list(hari)[:int(query.get("limit", 500))]])
+        if url.path.startswith("/v2/aggs/ticker/"):
+            mulai, sampai = url.path.rstrip("/").split("/")[-2:]
+            t0 = int(datetime.datetime.strptime(mulai, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+            t1 = int(datetime.datetime.strptime(sampai, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+            results = []
+            for t in range(t0, t1 + 1, 86400000):
+                o, h, l, c, v = (float(x) for x in _synthetic_ohlc(t))
+                results.append({"t": t, "o": o, "h": h, "l": l, "c": c, "v": v})
+            return self._reply({"status": "OK", "results": results})
+        self.send_error(404)
+
+    def do_POST(self):
+        panjang = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(panjang)
+        self._count(self.path)
+        time.sleep(self.latency)
+        if self.path.endswith("/sendMessage"):
+            return self._reply({"ok": True, "result": {"message_id": 1}})
+        if self.path.endswith("/sendPhoto"):
+            return self._reply({"ok": True, "result": {"photo": [{"file_id": f"stub-{time.monotonic_ns()}"}]}})
+        self.send_error(404)
+
+def _synthetic_ohlc(timestamp_ms):
+    """Candle harian deterministik (berubah halus per hari) dalam format kline Binance."""
+    hari = timestamp_ms // 86400000
+    close = BTC_USDT * (1 + 0.2 * np.sin(hari / 30.0) + 0.02 * np.sin(hari * 1.7))
+    return [f"{close * 0.99:.2f}", f"{close * 1.02:.2f}", f"{close * 0.97:.2f}", f"{close:.2f}", "1000.0"]
+
+class StubSheet:
+    """Worksheet tiruan di memori; setiap panggilan diberi jeda seperti permintaan ke Google Sheets."""
+    title = "Sheet1"
+
+    def __init__(self, rows, latency):
+        self.rows = [["Tanggal", "Modal Deposit (IDR)", "Harga BTC (IDR)", "Jumlah BTC Didapat"]] + rows
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _panggil(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+    def get(self, rng):
+        self._panggil()
+        mulai = int(re.match(r"A(\d+):D", rng).group(1))
+        with self._lock:
+            return [list(row) for row in self.rows[mulai - 1:]]
+
+    def get_all_values(self):
+        self._panggil()
+        with self._lock:
+            return [list(row) for row in self.rows]
+
+    def append_rows(self, values, **kwargs):
+        self._panggil()
+        with self._lock:
+            mulai = len(self.rows) + 1
+            self.rows += [[str(v) for v in row] for row in values]
+            return {"updates": {"updatedRange": f"{self.title}!A{mulai}:D{len(self.rows)}"}}
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], **kwargs)
+
+class StubSpreadsheet:
+    """Spreadsheet tiruan: worksheet pertama milik AUTHORIZED_USER_ID, worksheet lain bernama chat_id."""
+
+    def __init__(self, ledgers, latency):
+        self.latency = latency
+        self.worksheets = {}
+        for chat_id, rows in ledgers.items():
+            self.worksheets[str(chat_id)] = StubSheet(rows, latency)
+        self.sheet1 = self.worksheets.pop(str(BENCH_CHAT_ID))
+
+    def worksheet(self, title):
+        # Chat tanpa ledger sintetis mendapat worksheet kosong
+        if title not in self.worksheets:
+            self.worksheets[title] = StubSheet([], self.latency)
+        return self.worksheets[title]
+
+    @property
+    def calls(self):
+        return self.sheet1.calls + sum(sheet.calls for sheet in list(self.worksheets.values()))
+
+def synthetic_ledger(jumlah, seed=42):
+    """Ledger DCA sintetis: deposit berjarak tetap hingga hari ini, harga mengikuti random walk."""
+    rng = random.Random(seed)
+    sekarang = datetime.datetime.now().replace(microsecond=0)
+    # Ledger kecil memakai deposit harian; ledger besar dipadatkan agar rentangnya tetap beberapa tahun
+    jarak = datetime.timedelta(days=1) if jumlah <= 1500 else datetime.timedelta(days=1500) / jumlah
+    harga = 500000000.0
+    rows = []
+    for i in range(jumlah):
+        tanggal = sekarang - jarak * (jumlah - i)
+        harga *= 1 + rng.gauss(0.0005, 0.02)
+        modal = rng.choice((100000, 250000, 500000, 1000000))
+        rows.append([tanggal.strftime("%Y-%m-%d %H:%M:%S"), str(modal), f"{harga:.0f}", f"{modal / harga:.10f}".replace(".", ",")])
+    return rows
+
+# ==============================================================================
+# Pengukuran (berjalan di proses anak, satu per ukuran ledger)
+# ==============================================================================
+
+def _persentil(nilai):
+    if not nilai:
+        return {"n": 0}
+    data = np.asarray(nilai) * 1000
+    return {"n": len(nilai), "p50_ms": round(float(np.percentile(data, 50)), 2),
+            "p99_ms": round(float(np.percentile(data, 99)), 2), "mean_ms": round(float(data.mean()), 2)}
+
+def _peak_rss_mb():
+    # Linux melaporkan ru_maxrss dalam KiB
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def _stage_means(bot):
+    """Rata-rata durasi per tahap dari histogram metrik bot."""
+    hasil = {}
+    with bot._metrics_lock:
+        for (nama, label_key), hist in bot._histograms.items():
+            if nama == "bot_stage_seconds" and hist["count"]:
+                hasil[dict(label_key)["stage"]] = {"count": hist["count"], "mean_ms": round(hist["sum"] / hist["count"] * 1000, 2)}
+    return hasil
+
+def run_benchmark(args):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubUpstream)
+    StubUpstream.latency = args.upstream_latency_ms / 1000
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ.update({
+        "TELEGRAM_API_BASE": base, "BINANCE_API_BASE": base, "ER_API_BASE": base, "POLYGON_API_BASE": base,
+        "TELEGRAM_TOKEN": BENCH_TOKEN, "AUTHORIZED_USER_ID": str(BENCH_CHAT_ID), "NAMA_SPREADSHEET": "benchmark",
+        "AUTHORIZED_USER_IDS": ",".join(str(BENCH_CHAT_ID + i) for i in range(max(args.users, args.burst_chats))),
+        "POLYGON_API_KEY": "bench", "CACHE_DB_PATH": os.path.join(workdir, "bot_cache.db"),
+        "ALERT_POLL_INTERVAL": "0", "SNAPSHOT_CHECK_INTERVAL": "0", "SLOW_UPDATE_SECONDS": "1e9",
+    })
+    # Batas laju Telegram diukur terpisah; bisa diaktifkan kembali lewat environment
+    os.environ.setdefault("TELEGRAM_CHAT_INTERVAL", "0")
+    os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "100000")
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    log_bot = io.StringIO()
+    mulai = time.perf_counter()
+    with redirect_stdout(log_bot):
+        import bot_server_final_fix as bot
+    waktu_import = time.perf_counter() - mulai
+
+    # gspread tidak bisa diarahkan ke alamat lain, jadi spreadsheet tiruan dipasang di titik otorisasi
+    ledgers = {BENCH_CHAT_ID + i: synthetic_ledger(args.rows, seed=42 + i) for i in range(args.users)}
+    sheet = StubSpreadsheet(ledgers, args.sheets_latency_ms / 1000)
+    klien = SimpleNamespace(http_client=SimpleNamespace(auth=SimpleNamespace(expiry=None)))
+    bot._authorize_google_sheets = lambda: (klien, sheet)
+
+    client = bot.app.test_client()
+    nomor_update = iter(range(1, 10 ** 9))
+    kunci_nomor = threading.Lock()
+
+    def kirim(teks, chat_id=BENCH_CHAT_ID, webhook=client):
+        with kunci_nomor:
+            update_id = next(nomor_update)
+        data = {"update_id": update_id, "message": {"message_id": update_id, "chat": {"id": chat_id},
+                                                     "from": {"id": chat_id}, "text": teks}}
+        t0 = time.perf_counter()
+        status = webhook.post("/webhook", json=data).status_code
+        return status, time.perf_counter() - t0
+
+    def tunggu_selesai():
+        for update_queue in bot._worker_state["queues"]:
+            update_queue.join()
+        bot.flush_outbox()
+
+    def kosongkan_cache():
+        with bot._chart_lock:
+            bot._chart_cache.clear()
+        with bot._frame_lock:
+            bot._frame_cache.clear()
+        with bot._quote_lock:
+            bot._quote_cache.clear()
+
+    hasil = {"rows": args.rows, "users": args.users, "import_s": round(waktu_import, 3), "commands": {}}
+    with redirect_stdout(log_bot):
+        mulai = time.perf_counter()
+        for chat_id in ledgers:
+            bot.sync_ledger(chat_id, full=True)
+        hasil["initial_sync_s"] = round(time.perf_counter() - mulai, 3)
+
+        for perintah in [p.strip() for p in args.commands.split(",") if p.strip()]:
+            ack, total = [], []
+            for _ in range(args.warmup + args.iterations):
+                if args.cold:
+                    kosongkan_cache()
+                t0 = time.perf_counter()
+                _, durasi_ack = kirim(perintah)
+                tunggu_selesai()
+                durasi = time.perf_counter() - t0
+                ack.append(durasi_ack)
+                total.append(durasi)
+            ack, total = ack[args.warmup:], total[args.warmup:]
+            hasil["commands"][perintah] = dict(_persentil(total), ack=_persentil(ack),
+                                               throughput_per_s=round(len(total) / sum(total), 2) if total else 0.0)
+
+        if args.burst:
+            perintah = args.burst_command
+            status_ack = {}
+            ack = []
+
+            def kirim_burst(nomor):
+                # Satu test client per thread, seperti koneksi terpisah dari Telegram
+                status, durasi = kirim(perintah, chat_id=BENCH_CHAT_ID + nomor % args.burst_chats,
+                                       webhook=bot.app.test_client())
+                return status, durasi
+
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.burst_concurrency) as pool:
+                for status, durasi in pool.map(kirim_burst, range(args.burst)):
+                    status_ack[status] = status_ack.get(status, 0) + 1
+                    ack.append(durasi)
+            waktu_terima = time.perf_counter() - t0
+            tunggu_selesai()
+            waktu_total = time.perf_counter() - t0
+            diproses = status_ack.get(200, 0)
+            hasil["burst"] = {
+                "command": perintah, "updates": args.burst, "chats": args.burst_chats,
+                "concurrency": args.burst_concurrency, "status": {str(k): v for k, v in sorted(status_ack.items())},
+                "ack": _persentil(ack), "accept_s": round(waktu_terima, 3), "drain_s": round(waktu_total, 3),
+                "throughput_per_s": round(diproses / waktu_total, 2) if waktu_total else 0.0,
+            }
+
+        # Snapshot harian semua pengguna (dijadwalkan di produksi, di sini dipanggil langsung)
+        mulai = time.perf_counter()
+        bot.take_daily_snapshot()
+        hasil["snapshot_s"] = round(time.perf_counter() - mulai, 3)
+
+    hasil["stages"] = _stage_means(bot)
+    hasil["render_ms"] = hasil["stages"].get("render", {}).get("mean_ms")
+    hasil["sheet_calls"] = sheet.calls
+    hasil["upstream_calls"] = dict(sorted(StubUpstream.counts.items()))
+    hasil["peak_rss_mb"] = _peak_rss_mb()
+    server.shutdown()
+    return hasil
+
+# ==============================================================================
+# Laporan
+# ==============================================================================
+
+def print_report(hasil):
+    print(f"\n== Ledger {hasil['rows']:,} baris x {hasil['users']} pengguna ==")
+    print(f"import modul {hasil['import_s']:.2f} s | sinkronisasi awal {hasil['initial_sync_s']:.2f} s | "
+          f"peak RSS {hasil['peak_rss_mb']} MB | render rata-rata {hasil['render_ms'] or '-'} ms | "
+          f"snapshot harian {hasil['snapshot_s']:.3f} s")
+    print(f"{'perintah':<20}{'n':>5}{'p50 ms':>10}{'p99 ms':>10}{'ack p99':>10}{'per detik':>11}")
+    for perintah, d in hasil["commands"].items():
+        if not d["n"]:
+            continue
+        print(f"{perintah:<20}{d['n']:>5}{d['p50_ms']:>10.1f}{d['p99_ms']:>10.1f}{d['ack']['p99_ms']:>10.1f}{d['throughput_per_s']:>11.1f}")
+    burst = hasil.get("burst")
+    if burst:
+        print(f"burst '{burst['command']}': {burst['updates']} update / {burst['chats']} chat, "
+              f"konkurensi {burst['concurrency']} | status {burst['status']} | ack p50 {burst['ack'].get('p50_ms')} ms "
+              f"p99 {burst['ack'].get('p99_ms')} ms | selesai {burst['drain_s']} s | {burst['throughput_per_s']} update/detik")
+    tahap = ", ".join(f"{nama} {d['mean_ms']} ms" for nama, d in sorted(hasil["stages"].items()))
+    print(f"rata-rata per tahap: {tahap}")
+    print(f"panggilan Sheets {hasil['sheet_calls']} | layanan luar {hasil['upstream_calls']}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark bot dengan layanan luar tiruan.")
+    parser.add_argument("--rows", default=DEFAULT_ROWS, help="ukuran ledger sintetis, dipisah koma (default: %(default)s)")
+    parser.add_argument("--commands", default=DEFAULT_COMMANDS, help="perintah yang diukur berurutan, dipisah koma")
+    parser.add_argument("--users", type=int, default=1, help="jumlah pengguna, masing-masing dengan ledger sebesar --rows")
+    parser.add_argument("--iterations", type=int, default=20, help="pengukuran per perintah")
+    parser.add_argument("--warmup", type=int, default=1, help="putaran awal per perintah yang tidak dihitung")
+    parser.add_argument("--cold", action="store_true", help="kosongkan cache grafik, ledger & harga sebelum tiap putaran")
+    parser.add_argument("--upstream-latency-ms", type=float, default=20.0, help="jeda tiruan per permintaan HTTP")
+    parser.add_argument("--sheets-latency-ms", type=float, default=150.0, help="jeda tiruan per panggilan Google Sheets")
+    parser.add_argument("--burst", type=int, default=0, help="jumlah update yang dikirim bersamaan (0 = tanpa burst)")
+    parser.add_argument("--burst-chats", type=int, default=20, help="jumlah chat (pengguna terdaftar) berbeda dalam burst")
+    parser.add_argument("--burst-concurrency", type=int, default=16, help="jumlah pengirim webhook paralel")
+    parser.add_argument("--burst-command", default="cek harga", help="perintah yang dipakai dalam burst")
+    parser.add_argument("--json", action="store_true", help="cetak hasil mentah sebagai JSON")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if args.child:
+        args.rows = int(args.rows)
+        print(json.dumps(run_benchmark(args)))
+        return
+
+    semua = []
+    for ukuran in [int(x) for x in args.rows.split(",") if x.strip()]:
+        # Proses baru per ukuran: peak RSS, cache modul dan koneksi tidak terbawa antar pengukuran.
+        # argparse memakai --rows yang terakhir, jadi argumen asli bisa diteruskan apa adanya.
+        proses = subprocess.run([sys.executable, os.path.abspath(__file__), *argv, "--rows", str(ukuran), "--child"],
+                                capture_output=True, text=True)
+        if proses.returncode != 0:
+            sys.stderr.write(proses.stderr)
+            sys.exit(f"Benchmark untuk {ukuran} baris gagal.")
+        hasil = json.loads(proses.stdout.strip().splitlines()[-1])
+        semua.append(hasil)
+        if not args.json:
+            print_report(hasil)
+    if args.json:
+        print(json.dumps(semua, indent=2))
+
+if __name__ == "__main__":
+    main()
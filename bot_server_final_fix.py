@@ -1,18 +1,27 @@
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+# pandas, NumPy, matplotlib, dan gspread dimuat saat pertama kali dibutuhkan oleh perintah
+# (atau sekali di master oleh warm_up), agar worker baru tidak menunggu impor yang berat.
 import requests
 import datetime
 from flask import Flask, request, Response
 import os
 import json
-import pandas as pd
-import matplotlib
-matplotlib.use('Agg') # Mengatur backend matplotlib agar non-interaktif
-import matplotlib.pyplot as plt
-from matplotlib.ticker import FuncFormatter
 import traceback
-import numpy as np
 import time
+import threading
+import math
+import sqlite3
+import re
+import csv
+import io
+import queue
+import random
+import bisect
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import fcntl
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict, deque
 
 # ==============================================================================
 # BAGIAN 1: PENGATURAN & KREDENSIAL
@@ -20,12 +29,99 @@ import time
 
 # --- GANTI DENGAN INFORMASI ANDA ---
 NAMA_SPREADSHEET = os.environ.get("NAMA_SPREADSHEET")
-AUTHORIZED_USER_ID = int(os.environ.get("AUTHORIZED_USER_ID"))
+# Pemilik worksheet pertama (pengaturan lama); pengguna lain memakai worksheet bernama chat_id-nya
+AUTHORIZED_USER_ID = int(os.environ["AUTHORIZED_USER_ID"]) if os.environ.get("AUTHORIZED_USER_ID") else None
+# Semua chat_id yang boleh memakai bot, dipisah koma (AUTHORIZED_USER_ID selalu termasuk)
+AUTHORIZED_USER_IDS = {int(x) for x in os.environ.get("AUTHORIZED_USER_IDS", "").split(",") if x.strip()}
+if AUTHORIZED_USER_ID is not None:
+    AUTHORIZED_USER_IDS.add(AUTHORIZED_USER_ID)
 TELEGRAM_TOKEN = os.environ.get ("TELEGRAM_TOKEN")
-TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
 POLYGON_API_KEY = os.environ.get("POLYGON_API_KEY")
 # ------------------------------------
 
+# Alamat dasar layanan luar (bisa diarahkan ke server tiruan lokal, mis. oleh benchmark.py)
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+BINANCE_API_BASE = os.environ.get("BINANCE_API_BASE", "https://api.binance.com").rstrip("/")
+ER_API_BASE = os.environ.get("ER_API_BASE", "https://open.er-api.com").rstrip("/")
+POLYGON_API_BASE = os.environ.get("POLYGON_API_BASE", "https://api.polygon.io").rstrip("/")
+TELEGRAM_API_URL = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}"
+TELEGRAM_FILE_URL = f"{TELEGRAM_API_BASE}/file/bot{TELEGRAM_TOKEN}"
+
+# Pengaturan koneksi Google Sheets (dipakai bersama oleh semua thread worker)
+SHEETS_TIMEOUT = float(os.environ.get("SHEETS_TIMEOUT", "20"))
+SHEETS_TOKEN_REFRESH_MARGIN = int(os.environ.get("SHEETS_TOKEN_REFRESH_MARGIN", "300"))  # detik sebelum token kedaluwarsa
+
+# Cache lokal (SQLite) yang mencerminkan isi Google Sheet
+CACHE_DB_PATH = os.environ.get("CACHE_DB_PATH", "bot_cache.db")
+LEDGER_SYNC_INTERVAL = int(os.environ.get("LEDGER_SYNC_INTERVAL", "300"))  # detik antar sinkronisasi otomatis
+
+# Cache kuotasi harga: TTL per sumber dan batas usia data lama yang masih boleh dipakai saat sumber bermasalah
+QUOTE_SETTINGS = {
+    "btc_usdt": {"ttl": float(os.environ.get("BTC_PRICE_TTL", "15")), "max_stale": float(os.environ.get("BTC_PRICE_MAX_STALE", "3600"))},
+    "usd_idr": {"ttl": float(os.environ.get("FX_RATE_TTL", "21600")), "max_stale": float(os.environ.get("FX_RATE_MAX_STALE", "259200"))},
+}
+QUOTE_FAILURE_BACKOFF = float(os.environ.get("QUOTE_FAILURE_BACKOFF", "5"))  # detik jeda setelah gagal sebelum mencoba sumber lagi
+
+# Pemrosesan webhook di latar belakang
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "50"))  # kapasitas antrean per worker
+WEBHOOK_OVERFLOW_POLICY = os.environ.get("WEBHOOK_OVERFLOW_POLICY", "retry")  # 'retry' (HTTP 503) atau 'drop'
+
+# Penanda update yang sudah diproses (Telegram bisa mengirim ulang update yang sama)
+PROCESSED_UPDATE_TTL = int(os.environ.get("PROCESSED_UPDATE_TTL", "86400"))  # Telegram menyimpan update maksimal 24 jam
+PROCESSED_UPDATE_MAX = int(os.environ.get("PROCESSED_UPDATE_MAX", "10000"))
+
+# Mesin grafik
+CHART_PRICE_BUCKET = float(os.environ.get("CHART_PRICE_BUCKET", "0.005"))  # perubahan harga relatif yang memicu render ulang
+CHART_CACHE_SIZE = int(os.environ.get("CHART_CACHE_SIZE", "8"))
+CHART_MAX_LABELS = int(os.environ.get("CHART_MAX_LABELS", "40"))  # batas label tanggal di grafik
+
+# Pesan status
+TELEGRAM_MESSAGE_LIMIT = 4096
+STATUS_LOTS_PER_PAGE = int(os.environ.get("STATUS_LOTS_PER_PAGE", "10"))
+
+# Penyimpanan candle harian lokal untuk volatilitas & prediksi
+CANDLE_BACKFILL_DAYS = int(os.environ.get("CANDLE_BACKFILL_DAYS", "365"))  # juga batas maksimum jendela perhitungan
+CANDLE_RETRY_INTERVAL = int(os.environ.get("CANDLE_RETRY_INTERVAL", "600"))  # detik jeda setelah sinkronisasi candle gagal
+
+# Impor deposit massal
+IMPORT_MAX_ROWS = int(os.environ.get("IMPORT_MAX_ROWS", "2000"))
+IMPORT_MAX_FILE_BYTES = int(os.environ.get("IMPORT_MAX_FILE_BYTES", "1000000"))
+
+# Peringatan harga di latar belakang
+ALERT_POLL_INTERVAL = int(os.environ.get("ALERT_POLL_INTERVAL", "60"))  # detik; 0 = poller nonaktif
+ALERT_COOLDOWN = int(os.environ.get("ALERT_COOLDOWN", "3600"))  # detik sebelum target yang sama boleh memicu lagi
+
+# Snapshot harian portofolio semua pengguna
+SNAPSHOT_CHECK_INTERVAL = int(os.environ.get("SNAPSHOT_CHECK_INTERVAL", "300"))  # detik; 0 = tugas nonaktif
+DAILY_SNAPSHOT_HOUR_UTC = int(os.environ.get("DAILY_SNAPSHOT_HOUR_UTC", "16"))  # 16 UTC = 23 WIB, hari UTC = hari WIB
+DEFAULT_TARGET_PRICES = [2000000000, 2500000000, 3000000000, 3500000000, 4000000000, 
+                         4500000000, 5000000000, 5500000000, 6000000000, 6500000000, 
+                         7000000000, 7500000000, 8000000000, 8500000000, 9000000000, 
+                         9500000000, 10000000000, 10500000000, 11000000000, 11500000000, 
+                         12000000000, 12500000000, 13000000000, 13500000000, 14000000000, 
+                         14500000000, 15000000000, 15500000000, 16000000000, 16500000000, 
+                         17000000000, 17500000000, 18000000000, 18500000000, 19000000000, 
+                         20000000000]
+
+# Klien HTTP keluar (Telegram, Binance, ER-API, Polygon)
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "15"))
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", "3"))
+HTTP_BACKOFF_BASE = float(os.environ.get("HTTP_BACKOFF_BASE", "0.5"))  # detik, dilipatgandakan tiap percobaan
+HTTP_BACKOFF_MAX = float(os.environ.get("HTTP_BACKOFF_MAX", "10"))
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "10"))  # koneksi keep-alive per host
+# Waktu terlama satu http_request: setiap percobaan habis waktu, ditambah jeda backoff maksimum di antaranya
+HTTP_WORST_CASE_SECONDS = (HTTP_MAX_RETRIES + 1) * (HTTP_CONNECT_TIMEOUT + HTTP_READ_TIMEOUT) + HTTP_MAX_RETRIES * HTTP_BACKOFF_MAX
+
+# Antrean pesan keluar ke Telegram
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", "25"))  # pesan per detik untuk seluruh bot (batas Telegram ±30)
+TELEGRAM_CHAT_INTERVAL = float(os.environ.get("TELEGRAM_CHAT_INTERVAL", "1.0"))  # jeda minimum antar kiriman ke chat yang sama
+TELEGRAM_SENDER_THREADS = int(os.environ.get("TELEGRAM_SENDER_THREADS", "2"))
+
+# Metrik & log permintaan lambat
+SLOW_UPDATE_SECONDS = float(os.environ.get("SLOW_UPDATE_SECONDS", "5"))
+
 # Inisialisasi Flask App
 app = Flask(__name__)
 
@@ -33,82 +129,698 @@ app = Flask(__name__)
 # BAGIAN 2: FUNGSI-FUNGSI LOGIKA
 # ==============================================================================
 
-def setup_google_sheets():
-    scope = ["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets',
-             "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
+# --- Metrik: histogram waktu per tahap, penghitung cache & eror, diekspos di /metrics (format Prometheus) ---
+
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_HELP = {
+    "bot_stage_seconds": ("histogram", "Durasi per tahap pemrosesan (sheet_load, price_fetch, fx_fetch, analytics, render, upload, telegram_send, ...)."),
+    "bot_update_seconds": ("histogram", "Durasi total pemrosesan satu update Telegram per perintah."),
+    "bot_cache_total": ("counter", "Hit/miss cache per jenis cache."),
+    "bot_upstream_errors_total": ("counter", "Kegagalan permintaan ke layanan luar."),
+    "bot_updates_total": ("counter", "Update Telegram yang diterima webhook menurut hasilnya."),
+}
+
+_metrics_lock = threading.Lock()
+_histograms = {}   # (nama, label) -> {"buckets": [...], "sum": float, "count": int}
+_counters = {}     # (nama, label) -> float
+_update_context = threading.local()
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def observe(nama, nilai, **labels):
+    """Mencatat satu nilai ke histogram `nama`."""
+    with _metrics_lock:
+        hist = _histograms.setdefault((nama, _label_key(labels)), {"buckets": [0] * len(METRIC_BUCKETS), "sum": 0.0, "count": 0})
+        for index, batas in enumerate(METRIC_BUCKETS):
+            if nilai <= batas:
+                hist["buckets"][index] += 1
+        hist["sum"] += nilai
+        hist["count"] += 1
+
+def inc(nama, jumlah=1, **labels):
+    """Menambah penghitung `nama`."""
+    with _metrics_lock:
+        kunci = (nama, _label_key(labels))
+        _counters[kunci] = _counters.get(kunci, 0) + jumlah
+
+@contextmanager
+def ukur(tahap):
+    """Mengukur durasi satu tahap; juga dicatat ke rincian update yang sedang diproses di thread ini."""
+    mulai = time.perf_counter()
+    try:
+        yield
+    finally:
+        durasi = time.perf_counter() - mulai
+        observe("bot_stage_seconds", durasi, stage=tahap)
+        rincian = getattr(_update_context, "tahap", None)
+        if rincian is not None:
+            rincian[tahap] = rincian.get(tahap, 0.0) + durasi
+
+def _format_labels(label_key, **tambahan):
+    pasangan = list(label_key) + list(tambahan.items())
+    if not pasangan:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pasangan) + "}"
+
+def render_metrics(gauges=None):
+    """Menyusun semua metrik dalam format teks Prometheus."""
+    baris = []
+    with _metrics_lock:
+        histograms = {k: {"buckets": list(v["buckets"]), "sum": v["sum"], "count": v["count"]} for k, v in _histograms.items()}
+        counters = dict(_counters)
+    for nama, (jenis, keterangan) in METRIC_HELP.items():
+        baris += [f"# HELP {nama} {keterangan}", f"# TYPE {nama} {jenis}"]
+        for (nama_metrik, label_key), hist in sorted(histograms.items()):
+            if nama_metrik != nama:
+                continue
+            for batas, jumlah in zip(METRIC_BUCKETS, hist["buckets"]):
+                baris.append(f"{nama}_bucket{_format_labels(label_key, le=batas)} {jumlah}")
+            baris.append(f"{nama}_bucket{_format_labels(label_key, le='+Inf')} {hist['count']}")
+            baris.append(f"{nama}_sum{_format_labels(label_key)} {hist['sum']:.6f}")
+            baris.append(f"{nama}_count{_format_labels(label_key)} {hist['count']}")
+        for (nama_metrik, label_key), nilai in sorted(counters.items()):
+            if nama_metrik == nama:
+                baris.append(f"{nama}{_format_labels(label_key)} {nilai:g}")
+    for nama, nilai in (gauges or {}).items():
+        baris += [f"# TYPE {nama} gauge", f"{nama} {nilai}"]
+    return "\n".join(baris) + "\n"
+
+# --- Klien HTTP bersama: koneksi keep-alive per host, timeout seragam, retry dengan jitter ---
+
+# 418/429 = pembatasan laju (Binance/Telegram), 5xx = gangguan sementara di sisi server
+HTTP_RETRY_STATUSES = {418, 429, 500, 502, 503, 504}
+
+_http_lock = threading.Lock()
+_http_state = {"pid": None, "session": None, "executor": None}
+
+def _http_resources():
+    """Membuat sesi HTTP dan executor sekali per proses (dibuat ulang setelah fork)."""
+    with _http_lock:
+        if _http_state["pid"] != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_state["session"] = session
+            _http_state["executor"] = ThreadPoolExecutor(max_workers=4, thread_name_prefix="http-fetch")
+            _http_state["pid"] = os.getpid()
+        return _http_state
+
+def _retry_delay(attempt, response=None):
+    """Lama jeda sebelum percobaan berikutnya: Retry-After jika ada, selain itu backoff eksponensial dengan jitter."""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), HTTP_BACKOFF_MAX)
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+def http_request(method, url, idempotent=True, max_retries=None, **kwargs):
+    """Mengirim permintaan HTTP lewat sesi bersama dan mengembalikan respons yang sukses.
+
+    Kegagalan sementara dicoba ulang hingga HTTP_MAX_RETRIES kali. Permintaan yang tidak
+    idempoten (mis. mengirim pesan) hanya diulang jika server jelas belum memprosesnya
+    (429 atau gagal tersambung). Melempar requests.exceptions.RequestException jika tetap gagal.
+    """
+    try:
+        return _http_request(method, url, idempotent, max_retries, **kwargs)
+    except requests.exceptions.RequestException:
+        inc("bot_upstream_errors_total", upstream=urlsplit(url).hostname)
+        raise
+
+def _http_request(method, url, idempotent, max_retries, **kwargs):
+    if max_retries is None:
+        max_retries = HTTP_MAX_RETRIES
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    session = _http_resources()["session"]
+    for attempt in range(max_retries + 1):
+        terakhir = attempt == max_retries
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.exceptions.ConnectTimeout:
+            if terakhir:
+                raise
+            time.sleep(_retry_delay(attempt))
+            continue
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if terakhir or not idempotent:
+                raise
+            time.sleep(_retry_delay(attempt))
+            continue
+
+        bisa_diulang = response.status_code == 429 or (idempotent and response.status_code in HTTP_RETRY_STATUSES)
+        if bisa_diulang and not terakhir:
+            print(f"HTTP {response.status_code} dari {url.split('?')[0]}, mencoba lagi.")
+            time.sleep(_retry_delay(attempt, response))
+            continue
+        response.raise_for_status()
+        return response
+
+def run_in_background(fn, *args):
+    """Menjalankan fn di executor bersama dan mengembalikan Future-nya.
+
+    Rincian tahap update pemanggil ikut dibawa, jadi tahap yang diukur di executor
+    (mis. price_fetch) tetap muncul di log slow_update.
+    """
+    rincian = getattr(_update_context, "tahap", None)
+    def jalankan():
+        _update_context.tahap = rincian
+        try:
+            return fn(*args)
+        finally:
+            _update_context.tahap = None
+    return _http_resources()["executor"].submit(jalankan)
+
+SHEETS_SCOPE = ["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets',
+                "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
+
+# Klien Sheets tunggal per proses. Dibuat sekali lalu dipakai ulang (satu sesi HTTP keep-alive).
+_sheets_lock = threading.RLock()
+_sheets_state = {"client": None, "spreadsheet": None, "worksheets": {}}   # worksheets: chat_id -> worksheet
+
+def _authorize_google_sheets():
+    """Membuat klien gspread baru: parsing kredensial, OAuth, lalu membuka spreadsheet. Mengembalikan (client, spreadsheet)."""
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
     google_creds_json_str = os.environ.get('GOOGLE_CREDENTIALS_JSON')
     creds_dict = json.loads(google_creds_json_str)
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SHEETS_SCOPE)
     client = gspread.authorize(creds)
-    sheet = client.open(NAMA_SPREADSHEET).sheet1
-    return sheet
+    client.set_timeout(SHEETS_TIMEOUT)
+    client.http_client.login()
+    spreadsheet = client.open(NAMA_SPREADSHEET)
+    print("Koneksi Google Sheets berhasil dibuat.")
+    return client, spreadsheet
 
-def get_btc_price_from_binance():
-    """Mengambil harga BTC/USDT terkini dari Binance dengan penanganan error lebih baik."""
-    url = "https://api.binance.com/api/v3/ticker/price?symbol=BTCUSDT"
+def _open_worksheet(spreadsheet, chat_id):
+    """Worksheet ledger milik chat_id; dibuat (dengan baris header) jika belum ada."""
+    import gspread
+    if chat_id == AUTHORIZED_USER_ID:
+        return spreadsheet.sheet1
     try:
-        response = requests.get(url, timeout=10)
+        return spreadsheet.worksheet(str(chat_id))
+    except gspread.exceptions.WorksheetNotFound:
+        worksheet = spreadsheet.add_worksheet(title=str(chat_id), rows=1000, cols=len(LEDGER_COLUMNS))
+        worksheet.append_row(LEDGER_COLUMNS)
+        print(f"Worksheet ledger baru dibuat untuk chat_id {chat_id}.")
+        return worksheet
 
-        # Periksa apakah permintaan berhasil (kode status 2xx)
-        response.raise_for_status()
+def _refresh_token_if_needed(client):
+    """Memperbarui token OAuth lebih awal jika akan kedaluwarsa dalam waktu dekat."""
+    expiry = getattr(client.http_client.auth, 'expiry', None)
+    if expiry is None:
+        return
+    # google-auth menyimpan expiry sebagai datetime UTC tanpa tzinfo
+    sisa_detik = (expiry - datetime.datetime.utcnow()).total_seconds()
+    if sisa_detik < SHEETS_TOKEN_REFRESH_MARGIN:
+        client.http_client.login()
+        print("Token Google Sheets diperbarui.")
+
+def reset_google_sheets():
+    """Membuang klien Sheets yang ada sehingga panggilan berikutnya membuat koneksi baru."""
+    with _sheets_lock:
+        _sheets_state["client"] = None
+        _sheets_state["spreadsheet"] = None
+        _sheets_state["worksheets"] = {}
+
+def release_inherited_connections():
+    """Dipanggil di worker setelah fork: socket keep-alive Sheets milik master tidak boleh dipakai bersama.
+
+    Token OAuth tetap dipakai; koneksi baru dibuka oleh worker saat dibutuhkan.
+    """
+    with _sheets_lock:
+        if _sheets_state["client"] is not None:
+            _sheets_state["client"].http_client.session.close()
+
+def setup_google_sheets(chat_id):
+    """Mengembalikan worksheet milik chat_id; otorisasi hanya dilakukan saat belum ada koneksi."""
+    with _sheets_lock:
+        if _sheets_state["spreadsheet"] is None:
+            _sheets_state["client"], _sheets_state["spreadsheet"] = _authorize_google_sheets()
+        else:
+            _refresh_token_if_needed(_sheets_state["client"])
+        worksheets = _sheets_state["worksheets"]
+        if chat_id not in worksheets:
+            worksheets[chat_id] = _open_worksheet(_sheets_state["spreadsheet"], chat_id)
+        return worksheets[chat_id]
+
+def _is_reconnectable_error(e):
+    """Eror autentikasi atau jaringan yang layak dicoba ulang dengan koneksi baru."""
+    import gspread
+    import google.auth.exceptions
+    if isinstance(e, gspread.exceptions.APIError):
+        return e.code in (401, 403) or e.code >= 500
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                          google.auth.exceptions.TransportError, google.auth.exceptions.RefreshError))
+
+def with_sheet(chat_id, operation):
+    """Menjalankan operation(worksheet milik chat_id); jika gagal karena auth/jaringan, sambung ulang dan coba sekali lagi."""
+    try:
+        return operation(setup_google_sheets(chat_id))
+    except Exception as e:
+        if not _is_reconnectable_error(e):
+            raise
+        inc("bot_upstream_errors_total", upstream="sheets")
+        print(f"Koneksi Google Sheets bermasalah, menyambung ulang. Error: {e}")
+        reset_google_sheets()
+        return operation(setup_google_sheets(chat_id))
+
+# --- Ledger lokal: jalur baca untuk semua perintah, Google Sheet tetap sumber utama ---
+
+_ledger_lock = threading.RLock()       # melindungi koneksi SQLite
+_ledger_sync_locks = {}                # chat_id -> Lock; mencegah dua sinkronisasi ledger yang sama berjalan bersamaan
+_ledger_state = {"conn": None, "last_sync": {}}   # last_sync: chat_id -> waktu
+
+# Naikkan jika skema ledger/agregat berubah: keduanya hanya cerminan Google Sheets, jadi dibangun ulang
+LEDGER_SCHEMA_VERSION = 2   # 2: ledger & agregat per chat_id
+
+def _parse_angka(nilai):
+    """Mengubah nilai sel (bisa memakai koma desimal) menjadi float."""
+    return float(str(nilai).replace(',', '.'))
+
+def _ledger_conn():
+    """Membuka (sekali) koneksi SQLite ledger dan memastikan tabelnya ada."""
+    if _ledger_state["conn"] is None:
+        conn = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        if conn.execute("PRAGMA user_version").fetchone()[0] < LEDGER_SCHEMA_VERSION:
+            # Skema lama dibuang; sinkronisasi berikutnya mengisi ulang dari Google Sheets
+            conn.execute("DROP TABLE IF EXISTS ledger")
+            conn.execute("DROP TABLE IF EXISTS agregat")
+            conn.execute(f"PRAGMA user_version = {LEDGER_SCHEMA_VERSION}")
+        conn.execute("""CREATE TABLE IF NOT EXISTS ledger (
+                            chat_id INTEGER NOT NULL,
+                            baris INTEGER NOT NULL,
+                            tanggal TEXT NOT NULL,
+                            modal REAL NOT NULL,
+                            harga REAL NOT NULL,
+                            btc REAL NOT NULL,
+                            PRIMARY KEY (chat_id, baris))""")
+        # Agregat berjalan per pengguna yang diperbarui bersama setiap penambahan deposit
+        conn.execute("""CREATE TABLE IF NOT EXISTS agregat (
+                            chat_id INTEGER PRIMARY KEY,
+                            total_modal REAL NOT NULL,
+                            total_btc REAL NOT NULL,
+                            jumlah_deposit INTEGER NOT NULL,
+                            versi INTEGER NOT NULL)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS snapshot_harian (
+                            hari TEXT NOT NULL,
+                            chat_id INTEGER NOT NULL,
+                            total_modal REAL NOT NULL,
+                            total_btc REAL NOT NULL,
+                            jumlah_deposit INTEGER NOT NULL,
+                            harga_btc_idr REAL NOT NULL,
+                            nilai_aset REAL NOT NULL,
+                            keuntungan_rp REAL NOT NULL,
+                            keuntungan_persen REAL NOT NULL,
+                            PRIMARY KEY (hari, chat_id))""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS candle (
+                            sumber TEXT NOT NULL,
+                            hari TEXT NOT NULL,
+                            open REAL NOT NULL,
+                            high REAL NOT NULL,
+                            low REAL NOT NULL,
+                            close REAL NOT NULL,
+                            volume REAL NOT NULL,
+                            PRIMARY KEY (sumber, hari))""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS alert_harga (
+                            chat_id INTEGER NOT NULL,
+                            target REAL NOT NULL,
+                            PRIMARY KEY (chat_id, target))""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS update_diproses (
+                            update_id INTEGER PRIMARY KEY,
+                            waktu REAL NOT NULL)""")
+        conn.commit()
+        _ledger_state["conn"] = conn
+    return _ledger_state["conn"]
+
+def _parse_sheet_row(row):
+    """Mengubah satu baris sheet [tanggal, modal, harga, btc] menjadi tuple angka, atau None jika kosong."""
+    if not row or not str(row[0]).strip():
+        return None
+    row = list(row) + [''] * (4 - len(row))
+    hasil = [row[0]]
+    for nilai in row[1:4]:
+        try:
+            hasil.append(_parse_angka(nilai))
+        except ValueError:
+            print(f"Error konversi nilai ledger: {nilai}")
+            hasil.append(0.0)
+    return tuple(hasil)
+
+def _store_ledger_rows(chat_id, rows, replace_all=False):
+    """Menyimpan baris [(nomor_baris, tanggal, modal, harga, btc), ...] milik chat_id ke ledger lokal.
+
+    Agregat diperbarui dalam transaksi yang sama sehingga selalu konsisten dengan ledger.
+    """
+    with _ledger_lock:
+        conn = _ledger_conn()
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO agregat (chat_id, total_modal, total_btc, jumlah_deposit, versi) VALUES (?, 0, 0, 0, 0)", (chat_id,))
+            if replace_all:
+                conn.execute("DELETE FROM ledger WHERE chat_id = ?", (chat_id,))
+                conn.executemany("INSERT OR IGNORE INTO ledger (chat_id, baris, tanggal, modal, harga, btc) VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(chat_id,) + tuple(row) for row in rows])
+                conn.execute("""UPDATE agregat SET (total_modal, total_btc, jumlah_deposit) =
+                                (SELECT COALESCE(SUM(modal), 0), COALESCE(SUM(btc), 0), COUNT(*) FROM ledger WHERE chat_id = ?),
+                                versi = versi + 1 WHERE chat_id = ?""", (chat_id, chat_id))
+                return
+            tambah_modal, tambah_btc, tambah_jumlah = 0.0, 0.0, 0
+            for row in rows:
+                # Baris yang sudah ada tidak dihitung dua kali
+                if conn.execute("INSERT OR IGNORE INTO ledger (chat_id, baris, tanggal, modal, harga, btc) VALUES (?, ?, ?, ?, ?, ?)",
+                                (chat_id,) + tuple(row)).rowcount:
+                    tambah_modal += row[2]
+                    tambah_btc += row[4]
+                    tambah_jumlah += 1
+            if tambah_jumlah:
+                conn.execute("UPDATE agregat SET total_modal = total_modal + ?, total_btc = total_btc + ?, jumlah_deposit = jumlah_deposit + ?, versi = versi + 1 WHERE chat_id = ?",
+                             (tambah_modal, tambah_btc, tambah_jumlah, chat_id))
+
+def _read_sheet_rows(chat_id, mulai, akhir=None):
+    """Membaca baris mulai..akhir (inklusif; tanpa akhir = sampai baris terakhir) dari worksheet chat_id
+    sebagai [(nomor_baris, tanggal, modal, harga, btc), ...]; baris kosong dilewati."""
+    rentang = f"A{mulai}:D{akhir}" if akhir is not None else f"A{mulai}:D"
+    with ukur("sheet_load"):
+        values = with_sheet(chat_id, lambda sheet: sheet.get(rentang))
+    if akhir is not None:
+        values = values[:akhir - mulai + 1]
+    rows = []
+    for offset, row in enumerate(values):
+        parsed = _parse_sheet_row(row)
+        if parsed is not None:
+            rows.append((mulai + offset,) + parsed)
+    return rows
+
+def sync_ledger(chat_id, force=False, full=False):
+    """Mengambil baris baru dari worksheet milik chat_id ke ledger lokal.
+
+    Tanpa force, sinkronisasi hanya berjalan jika sudah lewat LEDGER_SYNC_INTERVAL.
+    Dengan full, ledger lokal pengguna ini dibangun ulang dari seluruh isi worksheet.
+    """
+    if not force and not full and time.time() - _ledger_state["last_sync"].get(chat_id, 0.0) < LEDGER_SYNC_INTERVAL:
+        return
+    with _ledger_lock:
+        sync_lock = _ledger_sync_locks.setdefault(chat_id, threading.Lock())
+    with sync_lock:
+        with _ledger_lock:
+            baris_terakhir = 1 if full else _ledger_conn().execute(
+                "SELECT COALESCE(MAX(baris), 1) FROM ledger WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+
+        # Hanya baris setelah baris terakhir yang sudah tersimpan (baris 1 adalah header)
+        rows = _read_sheet_rows(chat_id, baris_terakhir + 1)
+        _store_ledger_rows(chat_id, rows, replace_all=full)
+        if rows:
+            print(f"Sinkronisasi ledger {chat_id}: {len(rows)} baris dari Google Sheets.")
+        _ledger_state["last_sync"][chat_id] = time.time()
+
+def load_ledger_rows(chat_id):
+    """Mengembalikan semua deposit [(tanggal, modal, harga, btc), ...] milik chat_id dari ledger lokal."""
+    sync_ledger(chat_id)
+    with _ledger_lock:
+        return _ledger_conn().execute("SELECT tanggal, modal, harga, btc FROM ledger WHERE chat_id = ? ORDER BY baris", (chat_id,)).fetchall()
+
+def get_ledger_totals(chat_id):
+    """Membaca agregat portofolio chat_id (waktu konstan, tanpa memindai riwayat deposit)."""
+    sync_ledger(chat_id)
+    with _ledger_lock:
+        row = _ledger_conn().execute(
+            "SELECT total_modal, total_btc, jumlah_deposit, versi FROM agregat WHERE chat_id = ?", (chat_id,)).fetchone()
+    total_modal, total_btc, jumlah_deposit, versi = row or (0.0, 0.0, 0, 0)
+    return {
+        "versi": versi,  # naik setiap kali isi ledger berubah
+        "total_modal": total_modal,
+        "total_btc": total_btc,
+        "jumlah_deposit": jumlah_deposit,
+        # Harga rata-rata tertimbang volume = total modal / total BTC
+        "harga_rata_rata": total_modal / total_btc if total_btc > 0 else 0.0,
+    }
+
+def _row_number_from_update(response):
+    """Mengambil nomor baris pertama dari respons append (mis. 'Sheet1!A5:D9' -> 5)."""
+    updated_range = (response or {}).get('updates', {}).get('updatedRange', '')
+    match = re.search(r'![A-Z]+(\d+)', updated_range)
+    return int(match.group(1)) if match else None
+
+def record_deposits(chat_id, rows):
+    """Menulis banyak deposit [(tanggal, modal, harga, btc), ...] ke worksheet chat_id dalam satu permintaan,
+    lalu ke ledger lokal (write-through). Agregat diperbarui sekali untuk seluruh batch."""
+    sync_ledger(chat_id)
+    with _ledger_lock:
+        baris_terakhir = _ledger_conn().execute(
+            "SELECT COALESCE(MAX(baris), 1) FROM ledger WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+    # Penulisan tidak diulang otomatis agar deposit tidak tercatat ganda, tetapi klien yang rusak tetap
+    # dibuang supaya perintah berikutnya tidak terus memakai koneksi yang sama
+    try:
+        sheet = setup_google_sheets(chat_id)
+        with ukur("sheet_write"):
+            response = sheet.append_rows([list(row) for row in rows])
+    except Exception as e:
+        if _is_reconnectable_error(e):
+            inc("bot_upstream_errors_total", upstream="sheets")
+            print(f"Koneksi Google Sheets bermasalah, klien dibuat ulang pada permintaan berikutnya. Error: {e}")
+            reset_google_sheets()
+        raise
+    nomor_baris = _row_number_from_update(response)
+    if nomor_baris is None:
+        sync_ledger(chat_id, force=True)
+        return
+    baru = [(nomor_baris + offset, tanggal, float(modal), float(harga), float(btc))
+            for offset, (tanggal, modal, harga, btc) in enumerate(rows)]
+    # Baris yang ditambahkan langsung di sheet sejak sinkronisasi terakhir berada di antara ledger lokal
+    # dan baris baru; sinkronisasi berikutnya hanya membaca setelah baris baru, jadi celah ini dibaca sekarang
+    if nomor_baris > baris_terakhir + 1:
+        try:
+            baru = _read_sheet_rows(chat_id, baris_terakhir + 1, nomor_baris - 1) + baru
+        except Exception as e:
+            # Deposit sudah tercatat di sheet; tanpa menyimpan apa pun, sinkronisasi berikutnya membaca dari celah
+            print(f"Gagal membaca baris sebelum deposit baru, ledger lokal menyusul saat sinkronisasi. Error: {e}")
+            _ledger_state["last_sync"][chat_id] = 0.0
+            return
+    _store_ledger_rows(chat_id, baru)
+
+def record_deposit(chat_id, tanggal, modal, harga, btc):
+    """Menulis satu deposit ke worksheet chat_id lalu langsung ke ledger lokal (write-through)."""
+    record_deposits(chat_id, [(tanggal, modal, harga, btc)])
+
+def _fetch_btc_price_from_binance():
+    """Mengambil harga BTC/USDT terkini dari Binance dengan penanganan error lebih baik."""
+    url = f"{BINANCE_API_BASE}/api/v3/ticker/price?symbol=BTCUSDT"
+    try:
+        # Retry untuk 418/429 ditangani oleh http_request dengan jeda yang dibatasi
+        response = http_request('get', url)
 
         # Memeriksa apakah kunci 'price' ada sebelum mengaksesnya
-        if 'price' in response.json():
-            return float(response.json()['price'])
+        data = response.json()
+        if 'price' in data:
+            return float(data['price'])
         else:
             print("Eror: Kunci 'price' tidak ditemukan dalam respons Binance.")
             return None
 
     except requests.exceptions.RequestException as e:
-        if e.response and e.response.status_code == 418:
-            print("Error 418: Permintaan terlalu banyak, coba lagi setelah beberapa detik.")
-            time.sleep(5)  # Menunggu 5 detik sebelum mencoba lagi
-            return get_btc_price_from_binance()  # Coba lagi
         print(f"Gagal mengambil harga dari Binance. Error: {e}")
         return None
 
-def get_usd_to_idr_rate():
+def _fetch_usd_to_idr_rate():
     """Mengambil kurs USD ke IDR."""
-    url = "https://open.er-api.com/v6/latest/USD"
+    url = f"{ER_API_BASE}/v6/latest/USD"
     try:
-        response = requests.get(url)
-        response.raise_for_status()  # Memeriksa jika ada masalah dengan API
+        response = http_request('get', url)
         return float(response.json()['rates']['IDR'])
     except requests.exceptions.RequestException as e:
         print(f"Gagal mengambil kurs USD ke IDR. Error: {e}")
         return None
 
-def get_portfolio_status():
+# --- Cache kuotasi bersama: satu pengambilan untuk banyak permintaan yang bersamaan ---
+
+_QUOTE_FETCHERS = {
+    "btc_usdt": _fetch_btc_price_from_binance,
+    "usd_idr": _fetch_usd_to_idr_rate,
+}
+_quote_lock = threading.Lock()
+_quote_cache = {}      # nama -> {"value", "fetched_at", "failed_at"}
+_quote_inflight = {}   # nama -> threading.Event milik thread yang sedang mengambil data
+
+def get_quote(nama):
+    """Mengembalikan (nilai, stale) untuk kuotasi `nama`.
+
+    Nilai yang masih dalam TTL langsung dikembalikan. Jika kedaluwarsa, hanya satu thread
+    yang mengambil ulang; thread lain menunggu hasil yang sama. Jika sumber gagal, nilai lama
+    (selama belum melewati max_stale) dikembalikan dengan stale=True.
+    """
+    settings = QUOTE_SETTINGS[nama]
+    with _quote_lock:
+        entry = _quote_cache.get(nama)
+        now = time.time()
+        if entry and now - entry["fetched_at"] < settings["ttl"]:
+            inc("bot_cache_total", cache=f"quote_{nama}", result="hit")
+            return entry["value"], False
+        inc("bot_cache_total", cache=f"quote_{nama}", result="miss")
+        baru_gagal = entry is not None and now - entry.get("failed_at", 0) < QUOTE_FAILURE_BACKOFF
+        event = _quote_inflight.get(nama)
+        owner = event is None and not baru_gagal
+        if owner:
+            event = _quote_inflight[nama] = threading.Event()
+
+    if owner:
+        value = None
+        try:
+            with ukur("price_fetch" if nama == "btc_usdt" else "fx_fetch"):
+                value = _QUOTE_FETCHERS[nama]()
+        except Exception as e:
+            print(f"Gagal mengambil kuotasi {nama}. Error: {e}")
+        finally:
+            # Penunggu selalu dibangunkan, apa pun yang terjadi pada pengambilan
+            with _quote_lock:
+                entry = _quote_cache.setdefault(nama, {"value": None, "fetched_at": 0.0})
+                if value is not None:
+                    entry["value"], entry["fetched_at"] = value, time.time()
+                else:
+                    entry["failed_at"] = time.time()
+                del _quote_inflight[nama]
+            event.set()
+    elif event is not None:
+        # Menunggu selama pengambilan terlama yang mungkin (semua retry http_request), bukan batas tetap
+        event.wait(timeout=HTTP_WORST_CASE_SECONDS + 1)
+
+    with _quote_lock:
+        entry = _quote_cache.get(nama)
+        if not entry or entry["value"] is None:
+            return None, False
+        umur = time.time() - entry["fetched_at"]
+        if umur > settings["max_stale"]:
+            return None, False
+        if umur >= settings["ttl"]:
+            inc("bot_cache_total", cache=f"quote_{nama}", result="stale")
+        return entry["value"], umur >= settings["ttl"]
+
+def get_usd_to_idr_rate():
+    """Kurs USD ke IDR dari cache (diambil ulang dari ER-API setelah TTL habis)."""
+    return get_quote("usd_idr")[0]
+
+def get_btc_idr_price():
+    """Mengembalikan (harga_btc_idr, stale); harga None jika salah satu kuotasi tidak tersedia."""
+    # Harga BTC dan kurs diambil bersamaan
+    btc_future = run_in_background(get_quote, "btc_usdt")
+    kurs_usd_idr, kurs_stale = get_quote("usd_idr")
+    harga_btc_usd, btc_stale = btc_future.result()
+    if harga_btc_usd is None or kurs_usd_idr is None:
+        return None, False
+    return harga_btc_usd * kurs_usd_idr, btc_stale or kurs_stale
+
+STALE_NOTE = "\n_(Harga dari cache: sumber data sedang tidak tersedia)_"
+
+# --- Analitik portofolio: ledger dimuat sekali ke kolom pandas/NumPy, perhitungan dilakukan secara vektor ---
+
+LEDGER_COLUMNS = ['Tanggal', 'Modal Deposit (IDR)', 'Harga BTC (IDR)', 'Jumlah BTC Didapat']
+
+_frame_lock = threading.Lock()
+_frame_cache = {}   # chat_id -> {"versi", "df"}
+
+def load_ledger_frame(chat_id):
+    """Memuat ledger chat_id sebagai DataFrame terurut per tanggal; dipakai ulang selama versi ledger tidak berubah."""
+    import pandas as pd
+    versi = get_ledger_totals(chat_id)['versi']
+    with _frame_lock:
+        cache = _frame_cache.get(chat_id)
+    inc("bot_cache_total", cache="ledger_frame", result="hit" if cache and cache["versi"] == versi else "miss")
+    if not cache or cache["versi"] != versi:
+        # Dibangun di luar _frame_lock: load_ledger_rows bisa menyinkronkan Sheets dan tidak boleh menahan chat lain
+        df = pd.DataFrame(load_ledger_rows(chat_id), columns=LEDGER_COLUMNS)
+        # Baris yang diketik manual di sheet bisa memakai format tanggal lain; yang tidak terbaca dilewati
+        df['Tanggal'] = pd.to_datetime(df['Tanggal'], format='mixed', errors='coerce')
+        tidak_terbaca = df['Tanggal'].isna()
+        if tidak_terbaca.any():
+            print(f"Ledger {chat_id}: {int(tidak_terbaca.sum())} baris dengan tanggal tidak terbaca dilewati.")
+            df = df[~tidak_terbaca]
+        cache = {"versi": versi, "df": df.sort_values(by='Tanggal', kind='stable').reset_index(drop=True)}
+        with _frame_lock:
+            _frame_cache[chat_id] = cache
+    # Salinan agar pemanggil bebas menambah kolom
+    return cache["df"].copy()
+
+def compute_portfolio(df, harga_btc_idr):
+    """Menambahkan kolom P&L per lot dan nilai kumulatif (basis biaya, nilai aset, keuntungan) ke df."""
+    with ukur("analytics"):
+        return _compute_portfolio(df, harga_btc_idr)
+
+def _compute_portfolio(df, harga_btc_idr):
+    import numpy as np
+    modal = df['Modal Deposit (IDR)'].to_numpy(dtype=float)
+    btc = df['Jumlah BTC Didapat'].to_numpy(dtype=float)
+    total_modal = np.cumsum(modal)
+    total_btc = np.cumsum(btc)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nilai_lot = btc * harga_btc_idr
+        df['Nilai Kini (IDR)'] = nilai_lot
+        df['Keuntungan Lot (IDR)'] = nilai_lot - modal
+        df['Keuntungan Lot (%)'] = np.where(modal > 0, (nilai_lot - modal) / modal * 100, 0.0)
+
+        df['Total Modal (IDR)'] = total_modal
+        df['Total BTC'] = total_btc
+        df['Harga Rata-rata (IDR)'] = np.where(total_btc > 0, total_modal / total_btc, 0.0)
+        df['Nilai Aset (IDR)'] = total_btc * harga_btc_idr
+        df['Keuntungan (IDR)'] = df['Nilai Aset (IDR)'] - total_modal
+        df['Keuntungan (%)'] = np.where(total_modal > 0, df['Keuntungan (IDR)'] / total_modal * 100, 0.0)
+    return df
+
+def portfolio_summary(totals, harga_btc_idr):
+    """Nilai aset dan keuntungan total dari agregat ledger pada harga tertentu."""
+    nilai_aset = totals['total_btc'] * harga_btc_idr
+    keuntungan_rp = nilai_aset - totals['total_modal']
+    keuntungan_persen = (keuntungan_rp / totals['total_modal']) * 100 if totals['total_modal'] > 0 else 0
+    return {"nilai_aset": nilai_aset, "keuntungan_rp": keuntungan_rp, "keuntungan_persen": keuntungan_persen}
+
+def escape_markdown(teks):
+    """Meloloskan karakter khusus parse_mode 'Markdown' Telegram agar teks dari pengguna tampil apa adanya."""
+    return re.sub(r'([_*`\[])', r'\\\1', teks)
+
+def split_message(blocks, separator="\n--------------------\n", limit=TELEGRAM_MESSAGE_LIMIT):
+    """Menggabungkan blok teks menjadi sesedikit mungkin pesan yang masing-masing tidak melebihi limit."""
+    messages, current = [], ""
+    for block in blocks:
+        block = block[:limit]
+        kandidat = f"{current}{separator}{block}" if current else block
+        if len(kandidat) <= limit:
+            current = kandidat
+        else:
+            messages.append(current)
+            current = block
+    if current:
+        messages.append(current)
+    return messages
+
+def get_portfolio_status(chat_id, halaman=1):
+    """Ringkasan portofolio chat_id plus rincian deposit per halaman (terbaru lebih dulu), sebagai daftar pesan."""
     try:
-        sheet = setup_google_sheets()
-        values = sheet.get_all_values()
-        header = values[0]
-        data = values[1:]
-
-        btc_price = get_btc_price_from_binance()
-        idr_rate = get_usd_to_idr_rate()
-        if btc_price is None or idr_rate is None:
-            return "Gagal mengambil harga BTC atau kurs IDR. Silakan coba lagi."
-        
-        harga_btc_idr_saat_ini = btc_price * idr_rate
-        
-        portfolio_status = []  # Tambah inisialisasi list
-        
-        for row in data:
-            tanggal = row[0]
-            modal_deposit = float(row[1])
-            
-            try:
-                jumlah_btc_didapat = row[3].replace(',', '.')
-                jumlah_btc_didapat = float(jumlah_btc_didapat)
-            except ValueError:
-                print(f"Error konversi nilai BTC: {row[3]}")
-                jumlah_btc_didapat = 0.0
+        harga_btc_idr_saat_ini, harga_stale = get_btc_idr_price()
+        if harga_btc_idr_saat_ini is None:
+            return ["Gagal mengambil harga BTC atau kurs IDR. Silakan coba lagi."]
 
-            nilai_kini = jumlah_btc_didapat * harga_btc_idr_saat_ini
-            keuntungan = nilai_kini - modal_deposit
-            keuntungan_persen = (keuntungan / modal_deposit) * 100 if modal_deposit > 0 else 0
+        # Ringkasan dari agregat ledger (waktu konstan)
+        totals = get_ledger_totals(chat_id)
+        summary = portfolio_summary(totals, harga_btc_idr_saat_ini)
+        ringkasan = (f"*Ringkasan Portofolio ({totals['jumlah_deposit']} deposit)*\n"
+                     f"Total Modal: `Rp {totals['total_modal']:,.0f}`\n"
+                     f"Total BTC: `{totals['total_btc']:.8f}`\n"
+                     f"Harga Rata-rata: `Rp {totals['harga_rata_rata']:,.0f}`\n"
+                     f"Nilai Kini: `Rp {summary['nilai_aset']:,.0f}` ({summary['keuntungan_persen']:.2f}%)\n")
+        if harga_stale:
+            ringkasan += STALE_NOTE + "\n"
 
+        df = compute_portfolio(load_ledger_frame(chat_id), harga_btc_idr_saat_ini)
+        jumlah_halaman = max(1, math.ceil(len(df) / STATUS_LOTS_PER_PAGE))
+        halaman = min(max(halaman, 1), jumlah_halaman)
+        # Halaman 1 berisi deposit terbaru
+        akhir = len(df) - (halaman - 1) * STATUS_LOTS_PER_PAGE
+        lots = df.iloc[max(0, akhir - STATUS_LOTS_PER_PAGE):akhir].iloc[::-1]
+
+        portfolio_status = []
+        for tanggal, modal_deposit, jumlah_btc_didapat, nilai_kini, keuntungan, keuntungan_persen in zip(
+                lots['Tanggal'].dt.strftime("%Y-%m-%d %H:%M:%S"), lots['Modal Deposit (IDR)'], lots['Jumlah BTC Didapat'],
+                lots['Nilai Kini (IDR)'], lots['Keuntungan Lot (IDR)'], lots['Keuntungan Lot (%)']):
             status = "📈" if keuntungan >= 0 else "📉"
             keuntungan_str = f"Untung Rp {keuntungan:,.0f} ({keuntungan_persen:.2f}%)" if keuntungan >= 0 else f"Kerugian Rp {abs(keuntungan):,.0f} ({keuntungan_persen:.2f}%)"
 
@@ -118,147 +830,319 @@ def get_portfolio_status():
                                     f"Nilai Kini: `Rp {nilai_kini:,.0f}`\n"
                                     f"Status: {status} {keuntungan_str}\n")
 
-        return "\n--------------------\n".join(portfolio_status)
+        if jumlah_halaman > 1:
+            portfolio_status.append(f"Halaman {halaman}/{jumlah_halaman}. Ketik `status {halaman % jumlah_halaman + 1}` untuk halaman berikutnya.")
+
+        return split_message([ringkasan] + portfolio_status)
     
     except Exception as e:
         print(f"Gagal mengambil status portofolio: {e}")
-        return "Gagal mengambil data status portofolio."
-        
-def create_and_save_chart():
-    """Membaca data, menghitung statistik, dan membuat dasbor grafik canggih."""
-    try:
-        print("Membuat grafik...")
-        sheet = setup_google_sheets()
-        values = sheet.get_all_values()
-        header = values[0]
-        data = values[1:]
+        return ["Gagal mengambil data status portofolio."]
         
-        harga_btc_idr_saat_ini = get_btc_price_from_binance() * get_usd_to_idr_rate()
+# --- Mesin grafik: template figure dipakai ulang, hasil render disimpan per pengguna, versi ledger & harga ---
 
-        if len(data) < 2:
-            print("Tidak ada data yang cukup untuk dibuat grafik.")
-            return None
+WARNA_LATAR = '#121212'
+WARNA_NILAI_INVESTASI = '#3776c8'
+WARNA_MODAL_INVESTASI = 'white'
+
+# Figure matplotlib tidak thread-safe, jadi render dilakukan bergantian
+_chart_lock = threading.Lock()
+_chart_template = {}
+_chart_cache = OrderedDict()   # (chat_id, versi_ledger, bucket_harga) -> {"png", "file_id", "keuntungan_rp", "keuntungan_persen"}
+
+def _price_bucket(harga):
+    """Mengelompokkan harga ke bucket logaritmik selebar CHART_PRICE_BUCKET."""
+    return round(math.log(harga) / math.log1p(CHART_PRICE_BUCKET))
 
-        df = pd.DataFrame(data, columns=header)
-        df['Tanggal'] = pd.to_datetime(df['Tanggal'], format="%Y-%m-%d %H:%M:%S")
-        df['Modal Deposit (IDR)'] = pd.to_numeric(df['Modal Deposit (IDR)'])
-        df['Jumlah BTC Didapat'] = pd.to_numeric(df['Jumlah BTC Didapat'].astype(str).str.replace(',', '.', regex=False))
-        df = df.sort_values(by='Tanggal').reset_index(drop=True)
-
-        df['Total Modal (IDR)'] = df['Modal Deposit (IDR)'].cumsum()
-        df['Total BTC'] = df['Jumlah BTC Didapat'].cumsum()
-        df['Nilai Aset (IDR)'] = df['Total BTC'] * harga_btc_idr_saat_ini
-        df['Keuntungan (IDR)'] = df['Nilai Aset (IDR)'] - df['Total Modal (IDR)']
-        df['Keuntungan (%)'] = (df['Keuntungan (IDR)'] / df['Total Modal (IDR)']).replace([np.inf, -np.inf], 0).fillna(0) * 100
-
-        final_modal = df['Total Modal (IDR)'].iloc[-1]
-        final_nilai_aset = df['Nilai Aset (IDR)'].iloc[-1]
-        final_total_btc = df['Total BTC'].iloc[-1]
-        keuntungan_rp = final_nilai_aset - final_modal
-        keuntungan_persen = (keuntungan_rp / final_modal) * 100 if final_modal > 0 else 0
-
-        plt.style.use('dark_background')
-        fig, (ax_text, ax_chart) = plt.subplots(
-            nrows=2, ncols=1, figsize=(9, 16), facecolor='#121212', 
-            gridspec_kw={'height_ratios': [1, 4]}
-        )
+def _hide_axes_decorations(ax):
+    for spine in ['top', 'right', 'left', 'bottom']: ax.spines[spine].set_visible(False)
+    ax.tick_params(axis='both', which='both', length=0, labelbottom=False, labelleft=False)
+
+def _build_chart_template():
+    """Membuat figure dasbor sekali: gaya, panel teks, dan label statis."""
+    import matplotlib
+    matplotlib.use('Agg') # Mengatur backend matplotlib agar non-interaktif
+    import matplotlib.style
+    from matplotlib.figure import Figure
+    with matplotlib.style.context('dark_background'):
+        fig = Figure(figsize=(9, 16), facecolor=WARNA_LATAR)
+        ax_text, ax_chart = fig.subplots(nrows=2, ncols=1, gridspec_kw={'height_ratios': [1, 4]})
         fig.patch.set_edgecolor('white')
         fig.patch.set_linewidth(4)
-        
-        ax_text.set_facecolor('#121212')
-        for spine in ['top', 'right', 'left', 'bottom']: ax_text.spines[spine].set_visible(False)
-        ax_text.tick_params(axis='both', which='both', length=0)
-        ax_text.set_xticklabels([])
-        ax_text.set_yticklabels([])
+
+        ax_text.set_facecolor(WARNA_LATAR)
+        _hide_axes_decorations(ax_text)
         ax_text.set_ylim(0, 1)
-        
-        ax_text.text(0.5, 1, 'Riwayat Investasi', fontsize=22, fontweight='bold', color='white', ha='center')
-        
-        warna_nilai_investasi = '#3776c8'
-        warna_modal_investasi = 'white'
-        profit_color = 'lime' if keuntungan_persen >= 0 else 'red'
 
+        ax_text.text(0.5, 1, 'Riwayat Investasi', fontsize=22, fontweight='bold', color='white', ha='center')
         ax_text.text(0.05, 0.6, 'Modal Investasi', color='grey', fontsize=15, ha='left')
-        ax_text.text(0.05, 0.45, f'Rp {final_modal:,.0f}', color=warna_modal_investasi, fontsize=18, fontweight='bold', ha='left') 
         ax_text.text(0.05, 0.25, 'Total Aset Dibeli', color='grey', fontsize=12, ha='left')
-        ax_text.text(0.05, 0.1, f'{final_total_btc:.8f} BTC', color='white', fontsize=14, ha='left')
-
         ax_text.text(0.95, 0.6, 'Nilai Investasi', color='white', fontsize=15, ha='right')
-        ax_text.text(0.95, 0.45, f'Rp {final_nilai_aset:,.0f}', color=warna_nilai_investasi, fontsize=18, fontweight='bold', ha='right') 
-        ax_text.text(0.95, 0.35, f'(Harga BTC: Rp {harga_btc_idr_saat_ini:,.0f})', color='yellow', fontsize=9, ha='right', fontweight='bold')
-        
-        profit_arrow = '▲' if keuntungan_persen >= 0 else '▼'
-        profit_text_label = "Keuntungan" if keuntungan_persen >= 0 else "Kerugian"
-        ax_text.text(0.95, 0.15, profit_text_label, color=profit_color, fontsize=12, ha='right')
-        ax_text.text(0.95, 0.0, f'{profit_arrow} {keuntungan_persen:.1f}%', color=profit_color, fontsize=16, ha='right')
 
-        ax_chart.set_facecolor('#121212')
-        
-        data_min = min(df['Total Modal (IDR)'].min(), df['Nilai Aset (IDR)'].min())
-        data_max = max(df['Total Modal (IDR)'].max(), df['Nilai Aset (IDR)'].max())
-        data_range = data_max - data_min
-        if data_range == 0: data_range = data_max
-        df['Nilai_Aset_Plot'] = (df['Nilai Aset (IDR)'] - data_min) / data_range
-        start_modal_norm = (df['Total Modal (IDR)'].iloc[0] - data_min) / data_range
-        end_modal_norm = (df['Total Modal (IDR)'].iloc[-1] - data_min) / data_range
-
-        ax_chart.plot(df['Tanggal'], df['Nilai_Aset_Plot'], color=warna_nilai_investasi, linewidth=2.5, marker='o', markersize=5, zorder=10)
-        ax_chart.plot([df['Tanggal'].iloc[0], df['Tanggal'].iloc[-1]], [start_modal_norm, end_modal_norm], color=warna_modal_investasi, linewidth=1.5, marker='o', markersize=5, alpha=0.4)
-
-        profit_chart_base = 1.05
-        profit_chart_height = 0.25
-        profit_min, profit_max = df['Keuntungan (%)'].min(), df['Keuntungan (%)'].max()
-        profit_range = profit_max - profit_min
-        if profit_range == 0: profit_range = 1
-        df['Profit_Plot_Y'] = (((df['Keuntungan (%)'] - profit_min) / profit_range) * profit_chart_height) + profit_chart_base
-        ax_chart.plot(df['Tanggal'], df['Profit_Plot_Y'], color=profit_color, linewidth=2, marker='o', markersize=4)
-        zero_pct_pos = (((0 - profit_min) / profit_range) * profit_chart_height) + profit_chart_base
-        ax_chart.axhline(y=zero_pct_pos, color='white', linestyle='--', linewidth=1, alpha=0.3)
-
-        last_label_date = None
-        for index, row in df.iterrows():
-            current_date_str = row['Tanggal'].strftime('%d/%m')
-            if index == 0 or index == len(df) - 1 or current_date_str != last_label_date:
-                ax_chart.text(row['Tanggal'], row['Nilai_Aset_Plot'], f" {current_date_str}", fontsize=8, fontweight='bold', color=warna_nilai_investasi, ha='left', va='bottom')
-                ax_chart.text(row['Tanggal'], row['Profit_Plot_Y'], f" {current_date_str}", fontsize=7, color=profit_color, ha='left', va='bottom', fontweight='bold')
-                last_label_date = current_date_str
-        
-        for spine in ['top', 'right', 'left', 'bottom']: ax_chart.spines[spine].set_visible(False)
-        ax_chart.tick_params(axis='both', which='both', length=0)
-        ax_chart.set_xticklabels([])
-        ax_chart.set_yticklabels([])
-        ax_chart.set_xlabel('')
-        ax_chart.set_ylabel('')
-
-        chart_filename = "grafik_investasi.png"
-        plt.savefig(chart_filename, dpi=150, bbox_inches='tight', pad_inches=0.1, facecolor=fig.get_facecolor())
-        plt.close()
-        
-        print(f"Grafik berhasil disimpan sebagai {chart_filename}")
-        
-        # --- PERUBAHAN DI SINI: Mengembalikan data statistik ---
-        stats = {
-            "filename": chart_filename,  # Pastikan path file yang benar
-            "keuntungan_rp": keuntungan_rp,
-            "keuntungan_persen": keuntungan_persen
+        # Teks dinamis: isinya diganti di setiap render
+        texts = {
+            "modal": ax_text.text(0.05, 0.45, '', color=WARNA_MODAL_INVESTASI, fontsize=18, fontweight='bold', ha='left'),
+            "btc": ax_text.text(0.05, 0.1, '', color='white', fontsize=14, ha='left'),
+            "nilai": ax_text.text(0.95, 0.45, '', color=WARNA_NILAI_INVESTASI, fontsize=18, fontweight='bold', ha='right'),
+            "harga": ax_text.text(0.95, 0.35, '', color='yellow', fontsize=9, ha='right', fontweight='bold'),
+            "profit_label": ax_text.text(0.95, 0.15, '', fontsize=12, ha='right'),
+            "profit_persen": ax_text.text(0.95, 0.0, '', fontsize=16, ha='right'),
         }
+
+        ax_chart.set_facecolor(WARNA_LATAR)
+        _hide_axes_decorations(ax_chart)
+    return {"fig": fig, "ax_chart": ax_chart, "texts": texts}
+
+def _label_indices(tanggal_label):
+    """Indeks titik yang diberi label: awal, akhir, dan setiap pergantian tanggal (dibatasi CHART_MAX_LABELS)."""
+    import numpy as np
+    labels = np.asarray(tanggal_label)
+    mask = np.ones(len(labels), dtype=bool)
+    mask[1:] = labels[1:] != labels[:-1]
+    mask[-1] = True
+    indices = np.flatnonzero(mask)
+    if len(indices) > CHART_MAX_LABELS:
+        pilihan = np.unique(np.linspace(0, len(indices) - 1, CHART_MAX_LABELS).round().astype(int))
+        indices = indices[pilihan]
+    return indices
+
+def _render_chart(df, totals, harga_btc_idr_saat_ini):
+    """Menggambar data ke template figure dan mengembalikan PNG (bytes). Harus dipanggil di dalam _chart_lock."""
+    if not _chart_template:
+        _chart_template.update(_build_chart_template())
+    fig, ax_chart, texts = _chart_template["fig"], _chart_template["ax_chart"], _chart_template["texts"]
+
+    final_modal = totals['total_modal']
+    final_total_btc = totals['total_btc']
+    summary = portfolio_summary(totals, harga_btc_idr_saat_ini)
+    final_nilai_aset = summary['nilai_aset']
+    keuntungan_rp = summary['keuntungan_rp']
+    keuntungan_persen = summary['keuntungan_persen']
+    profit_color = 'lime' if keuntungan_persen >= 0 else 'red'
+    profit_arrow = '▲' if keuntungan_persen >= 0 else '▼'
+    profit_text_label = "Keuntungan" if keuntungan_persen >= 0 else "Kerugian"
+
+    texts["modal"].set_text(f'Rp {final_modal:,.0f}')
+    texts["btc"].set_text(f'{final_total_btc:.8f} BTC')
+    texts["nilai"].set_text(f'Rp {final_nilai_aset:,.0f}')
+    texts["harga"].set_text(f'(Harga BTC: Rp {harga_btc_idr_saat_ini:,.0f})')
+    texts["profit_label"].set_text(profit_text_label)
+    texts["profit_label"].set_color(profit_color)
+    texts["profit_persen"].set_text(f'{profit_arrow} {keuntungan_persen:.1f}%')
+    texts["profit_persen"].set_color(profit_color)
+
+    # Buang artist dari render sebelumnya
+    for artist in list(ax_chart.lines) + list(ax_chart.texts):
+        artist.remove()
+
+    data_min = min(df['Total Modal (IDR)'].min(), df['Nilai Aset (IDR)'].min())
+    data_max = max(df['Total Modal (IDR)'].max(), df['Nilai Aset (IDR)'].max())
+    data_range = data_max - data_min
+    if data_range == 0: data_range = data_max
+    nilai_aset_plot = ((df['Nilai Aset (IDR)'] - data_min) / data_range).to_numpy()
+    start_modal_norm = (df['Total Modal (IDR)'].iloc[0] - data_min) / data_range
+    end_modal_norm = (df['Total Modal (IDR)'].iloc[-1] - data_min) / data_range
+
+    tanggal = df['Tanggal'].to_numpy()
+    ax_chart.plot(tanggal, nilai_aset_plot, color=WARNA_NILAI_INVESTASI, linewidth=2.5, marker='o', markersize=5, zorder=10)
+    ax_chart.plot([tanggal[0], tanggal[-1]], [start_modal_norm, end_modal_norm], color=WARNA_MODAL_INVESTASI, linewidth=1.5, marker='o', markersize=5, alpha=0.4)
+
+    profit_chart_base = 1.05
+    profit_chart_height = 0.25
+    profit_min, profit_max = df['Keuntungan (%)'].min(), df['Keuntungan (%)'].max()
+    profit_range = profit_max - profit_min
+    if profit_range == 0: profit_range = 1
+    profit_plot_y = ((((df['Keuntungan (%)'] - profit_min) / profit_range) * profit_chart_height) + profit_chart_base).to_numpy()
+    ax_chart.plot(tanggal, profit_plot_y, color=profit_color, linewidth=2, marker='o', markersize=4)
+    zero_pct_pos = (((0 - profit_min) / profit_range) * profit_chart_height) + profit_chart_base
+    ax_chart.axhline(y=zero_pct_pos, color='white', linestyle='--', linewidth=1, alpha=0.3)
+
+    # Posisi label dipilih secara vektor; jumlahnya dibatasi agar waktu render tidak tumbuh dengan riwayat
+    tanggal_label = df['Tanggal'].dt.strftime('%d/%m').to_numpy()
+    for index in _label_indices(tanggal_label):
+        ax_chart.text(tanggal[index], nilai_aset_plot[index], f" {tanggal_label[index]}", fontsize=8, fontweight='bold', color=WARNA_NILAI_INVESTASI, ha='left', va='bottom')
+        ax_chart.text(tanggal[index], profit_plot_y[index], f" {tanggal_label[index]}", fontsize=7, color=profit_color, ha='left', va='bottom', fontweight='bold')
+
+    ax_chart.relim()
+    ax_chart.autoscale_view()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=150, bbox_inches='tight', pad_inches=0.1, facecolor=fig.get_facecolor())
+    return {"png": buffer.getvalue(), "file_id": None, "keuntungan_rp": keuntungan_rp, "keuntungan_persen": keuntungan_persen}
+
+def remember_chart_file_id(cache_key, file_id):
+    """Menyimpan file_id Telegram untuk grafik yang sudah pernah diunggah."""
+    with _chart_lock:
+        if cache_key in _chart_cache:
+            _chart_cache[cache_key]["file_id"] = file_id
+
+def create_chart(chat_id):
+    """Membaca data chat_id, menghitung statistik, dan membuat dasbor grafik canggih (PNG di memori)."""
+    try:
+        harga_btc_idr_saat_ini, _ = get_btc_idr_price()
+        if harga_btc_idr_saat_ini is None:
+            print("Gagal mengambil harga BTC atau kurs IDR untuk grafik.")
+            return None
+
+        # Angka header dibaca dari agregat ledger
+        totals = get_ledger_totals(chat_id)
+        if totals['jumlah_deposit'] < 2:
+            print("Tidak ada data yang cukup untuk dibuat grafik.")
+            return None
+
+        cache_key = (chat_id, totals['versi'], _price_bucket(harga_btc_idr_saat_ini))
+        with _chart_lock:
+            hasil = _chart_cache.get(cache_key)
+            if hasil is not None:
+                _chart_cache.move_to_end(cache_key)
+                # Salinan agar file_id bisa diisi tanpa mengubah entri cache di luar lock
+                stats = dict(hasil, cache_key=cache_key)
+        inc("bot_cache_total", cache="chart", result="hit" if hasil is not None else "miss")
+        if hasil is not None:
+            print("Grafik diambil dari cache.")
+            return stats
+
+        print("Membuat grafik...")
+        # Ledger dimuat di luar _chart_lock: sinkronisasi Sheets yang lambat tidak boleh menahan
+        # cache hit chat lain maupun remember_chart_file_id di thread pengirim Telegram
+        df = compute_portfolio(load_ledger_frame(chat_id), harga_btc_idr_saat_ini)
+        with _chart_lock:
+            hasil = _chart_cache.get(cache_key)
+            if hasil is None:
+                with ukur("render"):
+                    hasil = _render_chart(df, totals, harga_btc_idr_saat_ini)
+                _chart_cache[cache_key] = hasil
+                while len(_chart_cache) > CHART_CACHE_SIZE:
+                    _chart_cache.popitem(last=False)
+            stats = dict(hasil, cache_key=cache_key)
         return stats
-        # ----------------------------------------------------
     except Exception as e:
         print(f"Gagal membuat grafik. Laporan Eror Lengkap:")
         traceback.print_exc()
         return None
 
+# --- Candle harian lokal: diisi sekali, lalu hanya candle yang belum ada yang diambil ---
+
+def _utc_day(timestamp_ms):
+    return datetime.datetime.fromtimestamp(timestamp_ms / 1000, datetime.timezone.utc).strftime('%Y-%m-%d')
+
+def _fetch_binance_candles(mulai, sampai):
+    """Candle harian BTCUSDT dari Binance untuk rentang tanggal (date) inklusif."""
+    candles = []
+    start_ms = int(datetime.datetime.combine(mulai, datetime.time(), datetime.timezone.utc).timestamp() * 1000)
+    end_ms = int(datetime.datetime.combine(sampai, datetime.time(), datetime.timezone.utc).timestamp() * 1000)
+    while start_ms <= end_ms:
+        url = f"{BINANCE_API_BASE}/api/v3/klines?symbol=BTCUSDT&interval=1d&startTime={start_ms}&endTime={end_ms}&limit=1000"
+        data = http_request('get', url).json()
+        if not data:
+            break
+        candles += [(_utc_day(k[0]), float(k[1]), float(k[2]), float(k[3]), float(k[4]), float(k[5])) for k in data]
+        start_ms = data[-1][0] + 1
+    return candles
+
+def _fetch_polygon_candles(mulai, sampai):
+    """Candle harian X:BTCUSD dari Polygon.io untuk rentang tanggal (date) inklusif."""
+    url = f"{POLYGON_API_BASE}/v2/aggs/ticker/X:BTCUSD/range/1/day/{mulai.strftime('%Y-%m-%d')}/{sampai.strftime('%Y-%m-%d')}?adjusted=true&sort=asc&limit=50000&apiKey={POLYGON_API_KEY}"
+    data = http_request('get', url).json().get('results', [])
+    return [(_utc_day(d['t']), d['o'], d['h'], d['l'], d['c'], d.get('v', 0.0)) for d in data]
+
+_CANDLE_FETCHERS = {
+    "binance": _fetch_binance_candles,
+    "polygon": _fetch_polygon_candles,
+}
+_candle_locks = {sumber: threading.Lock() for sumber in _CANDLE_FETCHERS}
+_candle_next_attempt = {sumber: 0.0 for sumber in _CANDLE_FETCHERS}
+_candle_synced_until = {sumber: None for sumber in _CANDLE_FETCHERS}   # hari terakhir yang sudah dilengkapi di proses ini
+
+def sync_candles(sumber):
+    """Melengkapi candle harian yang sudah ditutup (sampai kemarin, UTC) untuk `sumber`."""
+    kemarin = datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=1)
+    kemarin_str = kemarin.strftime('%Y-%m-%d')
+    if _candle_synced_until[sumber] == kemarin_str:
+        return
+    with _candle_locks[sumber]:
+        if _candle_synced_until[sumber] == kemarin_str:
+            return
+        # Cakupan dihitung di seluruh jendela backfill, bukan hanya dari MAX(hari): blok yang tersimpan bisa berlubang
+        awal = kemarin - datetime.timedelta(days=CANDLE_BACKFILL_DAYS)
+        with _ledger_lock:
+            jumlah, terakhir = _ledger_conn().execute(
+                "SELECT COUNT(*), MAX(hari) FROM candle WHERE sumber = ? AND hari BETWEEN ? AND ?",
+                (sumber, awal.strftime('%Y-%m-%d'), kemarin_str)).fetchone()
+        mulai = awal
+        if terakhir is not None:
+            hari_terakhir = datetime.datetime.strptime(terakhir, '%Y-%m-%d').date()
+            if jumlah == (hari_terakhir - awal).days + 1:
+                # Blok utuh dari awal jendela sampai hari_terakhir: cukup ambil sisanya
+                if terakhir >= kemarin_str:
+                    _candle_synced_until[sumber] = kemarin_str
+                    return
+                mulai = hari_terakhir + datetime.timedelta(days=1)
+        if time.time() < _candle_next_attempt[sumber]:
+            return
+        try:
+            candles = _CANDLE_FETCHERS[sumber](mulai, kemarin)
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            print(f"Gagal memperbarui candle {sumber}. Error: {e}")
+            _candle_next_attempt[sumber] = time.time() + CANDLE_RETRY_INTERVAL
+            return
+        # Candle hari ini belum ditutup, jadi tidak disimpan
+        candles = [c for c in candles if c[0] <= kemarin.strftime('%Y-%m-%d')]
+        with _ledger_lock:
+            conn = _ledger_conn()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO candle (sumber, hari, open, high, low, close, volume) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 [(sumber,) + c for c in candles])
+        # Hari yang memang tidak ada di sumber tidak diminta ulang sampai hari berikutnya
+        _candle_synced_until[sumber] = kemarin_str
+        print(f"Candle {sumber}: {len(candles)} hari baru disimpan.")
+
+def load_closes(sumber, days):
+    """Harga penutupan `days` hari terakhir (terlama lebih dulu) sebagai array NumPy."""
+    import numpy as np
+    sync_candles(sumber)
+    with _ledger_lock:
+        rows = _ledger_conn().execute("SELECT close FROM candle WHERE sumber = ? ORDER BY hari DESC LIMIT ?", (sumber, days)).fetchall()
+    return np.array([row[0] for row in reversed(rows)], dtype=float)
+
+def candle_closes_for_days(sumber, hari_list):
+    """Harga penutupan untuk tanggal-tanggal tertentu ('YYYY-MM-DD'); candle yang belum tersimpan diambil sekali dalam satu rentang.
+
+    Candle yang diambil di sini tidak disimpan: tabel candle hanya diisi oleh sync_candles sebagai satu blok utuh.
+    """
+    hari_list = sorted(set(hari_list))
+    if not hari_list:
+        return {}
+
+    # Tanggal dalam jendela backfill langsung terbaca dari blok yang tersimpan
+    sync_candles(sumber)
+    with _ledger_lock:
+        placeholders = ",".join("?" * len(hari_list))
+        closes = dict(_ledger_conn().execute(
+            f"SELECT hari, close FROM candle WHERE sumber = ? AND hari IN ({placeholders})", [sumber] + hari_list).fetchall())
+    hilang = {hari for hari in hari_list if hari not in closes}
+    if hilang:
+        mulai = datetime.datetime.strptime(min(hilang), '%Y-%m-%d').date()
+        sampai = datetime.datetime.strptime(max(hilang), '%Y-%m-%d').date()
+        try:
+            candles = _CANDLE_FETCHERS[sumber](mulai, sampai)
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            # Tanggal yang tidak terbaca dilaporkan pemanggil sebagai 'harga tidak tersedia'
+            print(f"Gagal mengambil candle {sumber} {mulai}..{sampai}. Error: {e}")
+            return closes
+        closes.update((c[0], c[4]) for c in candles if c[0] in hilang)
+    return closes
+
 def get_btc_volatility(days=30):
+    """Volatilitas tahunan (%) dari log return harian selama `days` hari terakhir."""
+    import numpy as np
     try:
-        url = f"https://api.binance.com/api/v3/klines?symbol=BTCUSDT&interval=1d&limit={days}"
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()
-        closes = [float(candle[4]) for candle in data]
-        if len(closes) < 2:
+        closes = load_closes("binance", days + 1)
+        if len(closes) < days + 1:
+            # Candle belum lengkap (mis. backfill gagal): angka dari jendela yang lebih pendek akan salah label
+            print(f"Volatilitas {days} hari: hanya {len(closes)} candle tersedia.")
             return None
-        returns = np.log(np.array(closes[1:]) / np.array(closes[:-1]))
+        returns = np.diff(np.log(closes))
         vol = np.std(returns) * np.sqrt(365) * 100
         return vol
     except Exception as e:
@@ -266,63 +1150,631 @@ def get_btc_volatility(days=30):
         traceback.print_exc()
         return None
 
-def get_crypto_prediction_from_polygon(symbol='X:BTCUSD', days=30):
-    """Mengambil data harga historis dari Polygon.io untuk prediksi sederhana (misalnya, rata-rata atau tren)."""
-    url = f"https://api.polygon.io/v2/aggs/ticker/{symbol}/range/1/day/{(datetime.date.today() - datetime.timedelta(days=days)).strftime('%Y-%m-%d')}/{datetime.date.today().strftime('%Y-%m-%d')}?apiKey={POLYGON_API_KEY}"
+def get_crypto_prediction_from_polygon(days=30):
+    """Prediksi sederhana (tren terhadap rata-rata) dari candle Polygon.io; memakai candle Binance jika Polygon tidak tersedia."""
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()['results']
-        closes = [d['c'] for d in data]
-        avg_price = sum(closes) / len(closes)
+        closes = load_closes("polygon", days)
+        sumber = "Polygon.io"
+        if len(closes) < days:
+            # Kuota Polygon habis atau data belum lengkap: BTCUSDT cukup dekat dengan BTCUSD
+            closes = load_closes("binance", days)
+            sumber = "Binance"
+        if len(closes) == 0:
+            return None
+        avg_price = closes.mean()
         trend = "Naik" if closes[-1] > avg_price else "Turun"
-        return f"Prediksi tren BTC (berdasar {days} hari): {trend}. Harga rata-rata: ${avg_price:.2f}"
+        return f"Prediksi tren BTC (berdasar {len(closes)} hari, data {sumber}): {trend}. Harga rata-rata: ${avg_price:,.2f}"
     except Exception as e:
         print(f"Error Polygon: {e}")
         traceback.print_exc()
         return None
 
+# --- Impor deposit massal: parsing banyak baris, harga dari candle historis, satu kali tulis ke Sheets ---
+
+_IMPORT_DATE_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+
+# Kolom CSV riwayat transaksi bursa (mis. 'Date(UTC),Pair,Side,Price,Executed,Amount,Fee'), dikenali dari judul kolom
+_IMPORT_EXPORT_COLUMNS = {
+    "tanggal": ("date", "time", "datetime", "tanggal", "waktu"),
+    "pasangan": ("pair", "market", "symbol", "pasangan"),
+    "sisi": ("side", "type", "tipe"),
+    "harga": ("price", "harga"),
+    "jumlah": ("amount", "total", "jumlah"),
+}
+_IMPORT_IDR_QUOTES = ("IDR", "IDRT", "BIDR")
+
+def _parse_import_date(teks):
+    for fmt in _IMPORT_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(teks.strip(), fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"tanggal tidak dikenali: {teks}")
+
+def _parse_import_line(line):
+    """Satu baris 'tanggal [jam] jumlah [harga_btc_idr]' (dipisah spasi, koma, titik koma, atau tab)."""
+    tokens = [t for t in re.split(r'[,;\t ]+', line.strip()) if t]
+    if len(tokens) >= 2 and re.fullmatch(r'\d{1,2}:\d{2}(:\d{2})?', tokens[1]):
+        tokens = [f"{tokens[0]} {tokens[1]}"] + tokens[2:]
+    if len(tokens) not in (2, 3):
+        raise ValueError("jumlah kolom tidak sesuai")
+    waktu = _parse_import_date(tokens[0])
+    jumlah = float(tokens[1])
+    harga = float(tokens[2]) if len(tokens) == 3 else None
+    if jumlah <= 0 or (harga is not None and harga <= 0):
+        raise ValueError("jumlah dan harga harus positif")
+    return waktu, jumlah, harga
+
+def _export_columns(header):
+    """Memetakan judul kolom CSV bursa ke indeksnya; None jika baris bukan judul CSV yang dikenali."""
+    delimiter = next((d for d in (',', ';', '\t') if d in header), None)
+    if delimiter is None:
+        return None
+    kolom = {}
+    for indeks, judul in enumerate(next(csv.reader([header], delimiter=delimiter))):
+        # 'Date(UTC)' -> 'date'
+        judul = re.sub(r'\(.*?\)', '', judul).strip().lower()
+        for nama, alias in _IMPORT_EXPORT_COLUMNS.items():
+            if judul in alias:
+                kolom.setdefault(nama, indeks)
+    if "tanggal" not in kolom or "jumlah" not in kolom:
+        return None
+    return delimiter, kolom
+
+def _parse_export_number(teks):
+    """Angka dari sel CSV bursa, mis. '1,000,000.00IDR' -> (1000000.0, 'IDR')."""
+    match = re.fullmatch(r'([\d,]*\.?\d+)\s*([A-Za-z]*)', teks.strip())
+    if not match:
+        raise ValueError(f"angka tidak dikenali: {teks}")
+    return float(match.group(1).replace(',', '')), match.group(2).upper()
+
+def _parse_export_row(kolom, values):
+    """Satu transaksi dari CSV bursa. Hanya pembelian BTC dengan IDR yang menjadi deposit."""
+    sel = {nama: values[indeks] if indeks < len(values) else "" for nama, indeks in kolom.items()}
+    if not sel["tanggal"].strip() or not sel["jumlah"].strip():
+        raise ValueError("jumlah kolom tidak sesuai")
+    if "sisi" in sel and sel["sisi"].strip().upper() not in ("BUY", "BELI"):
+        raise ValueError(f"bukan transaksi beli ({sel['sisi'].strip()})")
+    if "pasangan" in sel:
+        pasangan = re.sub(r'[^A-Z]', '', sel["pasangan"].upper())
+        if not pasangan.startswith("BTC") or pasangan[3:] not in _IMPORT_IDR_QUOTES:
+            raise ValueError(f"pasangan {sel['pasangan'].strip()} tidak didukung, hanya BTC/IDR")
+    waktu = _parse_import_date(sel["tanggal"])
+    jumlah, mata_uang = _parse_export_number(sel["jumlah"])
+    if mata_uang and mata_uang not in _IMPORT_IDR_QUOTES:
+        raise ValueError(f"jumlah dalam {mata_uang} tidak didukung, hanya IDR")
+    harga = _parse_export_number(sel["harga"])[0] if sel.get("harga", "").strip() else None
+    if jumlah <= 0 or (harga is not None and harga <= 0):
+        raise ValueError("jumlah dan harga harus positif")
+    return waktu, jumlah, harga
+
+def parse_import(text):
+    """Mengurai teks impor menjadi (deposit, kesalahan). Baris judul kolom dan baris kosong dilewati.
+
+    Jika sebelum baris data ada judul kolom CSV bursa (lihat _IMPORT_EXPORT_COLUMNS), kolom dibaca
+    menurut judulnya; selain itu setiap baris memakai format 'tanggal [jam] jumlah [harga_btc_idr]'.
+    """
+    lines = text.splitlines()
+    for awal, line in enumerate(lines):
+        if line.strip()[:1].isdigit():
+            break
+        header = _export_columns(line)
+        if header:
+            return _parse_export(lines[awal + 1:], *header, nomor_awal=awal + 2)
+
+    deposits, errors = [], []
+    for nomor, line in enumerate(lines, start=1):
+        if not line.strip() or not line.strip()[0].isdigit():
+            continue
+        try:
+            deposits.append(_parse_import_line(line))
+        except ValueError as e:
+            errors.append(f"Baris {nomor}: {e}")
+    return deposits, errors
+
+def _parse_export(lines, delimiter, kolom, nomor_awal):
+    deposits, errors = [], []
+    for nomor, values in enumerate(csv.reader(lines, delimiter=delimiter), start=nomor_awal):
+        if not any(value.strip() for value in values):
+            continue
+        try:
+            deposits.append(_parse_export_row(kolom, values))
+        except ValueError as e:
+            errors.append(f"Baris {nomor}: {e}")
+    return deposits, errors
+
+def price_deposits(deposits):
+    """Menentukan harga BTC (IDR) tiap deposit; tanpa harga eksplisit dipakai penutupan candle harian pada tanggalnya.
+
+    Kurs historis tidak tersedia dari ER-API, jadi harga USDT dikonversi dengan kurs USD/IDR saat ini.
+    Deposit hari ini memakai harga terkini.
+    """
+    kurs_usd_idr = get_usd_to_idr_rate()
+    harga_kini, _ = get_btc_idr_price()
+    hari_ini = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
+    perlu_candle = [waktu.strftime('%Y-%m-%d') for waktu, _, harga in deposits if harga is None and waktu.strftime('%Y-%m-%d') < hari_ini]
+    closes = candle_closes_for_days("binance", perlu_candle) if perlu_candle else {}
+
+    rows, errors = [], []
+    for waktu, jumlah, harga in sorted(deposits, key=lambda d: d[0]):
+        hari = waktu.strftime('%Y-%m-%d')
+        if harga is None:
+            if hari >= hari_ini:
+                harga = harga_kini
+            elif hari in closes and kurs_usd_idr is not None:
+                harga = closes[hari] * kurs_usd_idr
+        if harga is None:
+            errors.append(f"{hari}: harga tidak tersedia")
+            continue
+        rows.append((waktu.strftime("%Y-%m-%d %H:%M:%S"), jumlah, harga, jumlah / harga))
+    return rows, errors
+
+def download_telegram_file(file_id):
+    """Mengunduh isi dokumen yang dikirim pengguna (mis. CSV ekspor bursa) sebagai teks."""
+    info = http_request('get', f"{TELEGRAM_API_URL}/getFile", params={"file_id": file_id}).json()['result']
+    if info.get('file_size', 0) > IMPORT_MAX_FILE_BYTES:
+        raise ValueError("berkas terlalu besar")
+    return http_request('get', f"{TELEGRAM_FILE_URL}/{info['file_path']}").content.decode('utf-8-sig')
+
+def import_deposits(chat_id, text):
+    """Menjalankan impor massal: parsing, penetapan harga, satu append_rows, lalu satu render grafik."""
+    import gspread
+    import google.auth.exceptions
+    deposits, errors = parse_import(text)
+    if not deposits:
+        send_telegram_message(chat_id, "Tidak ada deposit yang bisa diimpor.\nFormat per baris: `YYYY-MM-DD [HH:MM] jumlah [harga_btc_idr]`, "
+                                       "atau CSV riwayat transaksi bursa dengan kolom `Date`, `Pair`, `Side`, `Price`, `Amount` (pembelian BTC/IDR).")
+        return
+    if len(deposits) > IMPORT_MAX_ROWS:
+        send_telegram_message(chat_id, f"Terlalu banyak baris ({len(deposits)}). Maksimal {IMPORT_MAX_ROWS} per impor.")
+        return
+    send_telegram_message(chat_id, f"Mengimpor {len(deposits)} deposit...")
+
+    rows, price_errors = price_deposits(deposits)
+    errors += price_errors
+    if rows:
+        try:
+            record_deposits(chat_id, rows)
+        except (requests.exceptions.RequestException, gspread.exceptions.APIError, google.auth.exceptions.GoogleAuthError) as e:
+            print(f"Gagal menulis impor ke Google Sheets. Error: {e}")
+            send_telegram_message(chat_id, "❌ Impor gagal, tidak ada deposit yang dicatat. Google Sheets sedang tidak dapat ditulis, silakan coba lagi.")
+            return
+
+    totals = get_ledger_totals(chat_id)
+    pesan = (f"✅ *Impor selesai.* {len(rows)} deposit dicatat"
+             f" (Rp {sum(row[1] for row in rows):,.0f}, {sum(row[3] for row in rows):.8f} BTC).\n"
+             f"Total Aset Anda: *{totals['total_btc']:.8f} BTC* dari {totals['jumlah_deposit']} deposit.")
+    if errors:
+        # Pesan kesalahan memuat potongan input pengguna; tanpa escape, Telegram menolak seluruh pesan (400)
+        pesan += f"\n\n⚠️ {len(errors)} baris dilewati:\n" + "\n".join(escape_markdown(error) for error in errors[:20])
+    send_telegram_message(chat_id, pesan)
+
+    if rows:
+        chart_data = create_chart(chat_id)
+        if chart_data:
+            send_chart(chat_id, chart_data, caption="Berikut dasbor investasi Anda.")
+
+# --- Peringatan harga: indeks target terurut, satu pengambilan harga untuk semua pengguna ---
+
+_alert_lock = threading.Lock()
+_alert_index = {"targets": [], "chats": {}}   # targets terurut; chats: target -> set(chat_id)
+_alert_state = {"pid": None, "harga_sebelumnya": None, "terakhir_kirim": {}}
+
+def _load_alert_index():
+    """Membangun ulang indeks target dari tabel alert_harga. Harus dipanggil di dalam _alert_lock."""
+    with _ledger_lock:
+        rows = _ledger_conn().execute("SELECT chat_id, target FROM alert_harga").fetchall()
+    chats = {}
+    for chat_id, target in rows:
+        chats.setdefault(target, set()).add(chat_id)
+    _alert_index.update(targets=sorted(chats), chats=chats)
+
+def get_alert_targets(chat_id):
+    """Daftar target harga (terurut) milik chat_id, dibaca langsung dari SQLite agar perubahan dari worker lain terlihat."""
+    with _ledger_lock:
+        rows = _ledger_conn().execute("SELECT target FROM alert_harga WHERE chat_id = ? ORDER BY target", (chat_id,)).fetchall()
+    return [target for (target,) in rows]
+
+def set_alert_target(chat_id, target, aktif=True):
+    """Menambah (aktif=True) atau menghapus target harga untuk chat_id."""
+    with _alert_lock:
+        with _ledger_lock:
+            conn = _ledger_conn()
+            with conn:
+                if aktif:
+                    conn.execute("INSERT OR IGNORE INTO alert_harga (chat_id, target) VALUES (?, ?)", (chat_id, float(target)))
+                else:
+                    conn.execute("DELETE FROM alert_harga WHERE chat_id = ? AND target = ?", (chat_id, float(target)))
+
+def crossed_targets(harga_sebelumnya, harga_sekarang):
+    """Target yang dilewati di antara dua harga, beserta arahnya ('naik' atau 'turun')."""
+    targets = _alert_index["targets"]
+    if harga_sekarang > harga_sebelumnya:
+        awal, akhir = bisect.bisect_right(targets, harga_sebelumnya), bisect.bisect_right(targets, harga_sekarang)
+        return targets[awal:akhir], 'naik'
+    awal, akhir = bisect.bisect_left(targets, harga_sekarang), bisect.bisect_left(targets, harga_sebelumnya)
+    return targets[awal:akhir], 'turun'
+
+def check_price_alerts():
+    """Satu putaran poller: bandingkan harga cache dengan harga sebelumnya dan kirim peringatan yang perlu."""
+    harga_sekarang, harga_stale = get_btc_idr_price()
+    if harga_sekarang is None or harga_stale:
+        return
+    pesan_per_chat = {}
+    with _alert_lock:
+        # Dimuat ulang setiap putaran: 'alert tambah/hapus' bisa ditangani worker gunicorn lain
+        _load_alert_index()
+        harga_sebelumnya = _alert_state["harga_sebelumnya"]
+        _alert_state["harga_sebelumnya"] = harga_sekarang
+        if harga_sebelumnya is None or harga_sebelumnya == harga_sekarang:
+            return
+        targets, arah = crossed_targets(harga_sebelumnya, harga_sekarang)
+        now = time.time()
+        for target in targets:
+            for chat_id in _alert_index["chats"][target]:
+                # Debounce: target yang sama tidak memicu lagi selama ALERT_COOLDOWN
+                kunci = (chat_id, target)
+                if now - _alert_state["terakhir_kirim"].get(kunci, 0) < ALERT_COOLDOWN:
+                    continue
+                _alert_state["terakhir_kirim"][kunci] = now
+                pesan_per_chat.setdefault(chat_id, []).append(target)
+
+    simbol = "🚀" if arah == 'naik' else "🔻"
+    for chat_id, targets_chat in pesan_per_chat.items():
+        daftar = ", ".join(f"Rp {target:,.0f}" for target in targets_chat)
+        send_telegram_message(chat_id, f"🚨 {simbol} Harga BTC {arah} melewati target {daftar}.\nSaat ini harga BTC: Rp {harga_sekarang:,.0f}")
+
+def _alert_poller_loop():
+    while True:
+        try:
+            check_price_alerts()
+        except Exception:
+            traceback.print_exc()
+        time.sleep(ALERT_POLL_INTERVAL)
+
+_leader_locks = {}   # nama tugas -> file lock yang dipegang proses ini
+
+def _acquire_leader_lock(nama):
+    """True jika proses ini menjadi satu-satunya pelaksana tugas latar `nama` (file lock di samping CACHE_DB_PATH)."""
+    lock_file = open(f"{CACHE_DB_PATH}.{nama}.lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        # Proses lain sudah menjalankan tugas ini
+        lock_file.close()
+        return False
+    _leader_locks[nama] = lock_file
+    return True
+
+def start_alert_poller():
+    """Menjalankan poller sekali per proses, dan hanya di satu proses (dijaga dengan file lock)."""
+    if ALERT_POLL_INTERVAL <= 0:
+        return
+    with _alert_lock:
+        if _alert_state["pid"] == os.getpid():
+            return
+        _alert_state["pid"] = os.getpid()
+        if not _acquire_leader_lock("alert"):
+            return
+    threading.Thread(target=_alert_poller_loop, name="alert-poller", daemon=True).start()
+    print("Poller peringatan harga berjalan.")
+
+# --- Snapshot harian: nilai portofolio semua pengguna pada satu harga, dihitung secara vektor ---
+
+_snapshot_lock = threading.Lock()
+_snapshot_state = {"pid": None, "hari_terakhir": None}
+
+def take_daily_snapshot(hari=None):
+    """Menyimpan nilai portofolio semua pengguna ke snapshot_harian; mengembalikan jumlah pengguna, atau None jika harga tidak tersedia."""
+    import numpy as np
+    import pandas as pd
+    harga_btc_idr, harga_stale = get_btc_idr_price()
+    if harga_btc_idr is None or harga_stale:
+        return None
+    hari = hari or datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
+    for chat_id in sorted(AUTHORIZED_USER_IDS):
+        try:
+            sync_ledger(chat_id)
+        except Exception as e:
+            print(f"Snapshot: sinkronisasi ledger {chat_id} gagal, memakai ledger lokal. Error: {e}")
+
+    with ukur("snapshot"):
+        # Satu baris agregat per pengguna; seluruh pengguna dihitung sekaligus tanpa memindai riwayat deposit
+        with _ledger_lock:
+            df = pd.read_sql_query("SELECT chat_id, total_modal, total_btc, jumlah_deposit FROM agregat", _ledger_conn())
+        df = df[df['chat_id'].isin(list(AUTHORIZED_USER_IDS))].copy()
+        df['harga_btc_idr'] = harga_btc_idr
+        df['nilai_aset'] = df['total_btc'] * harga_btc_idr
+        df['keuntungan_rp'] = df['nilai_aset'] - df['total_modal']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            df['keuntungan_persen'] = np.where(df['total_modal'] > 0, df['keuntungan_rp'] / df['total_modal'] * 100, 0.0)
+
+        kolom = ['chat_id', 'total_modal', 'total_btc', 'jumlah_deposit', 'harga_btc_idr', 'nilai_aset', 'keuntungan_rp', 'keuntungan_persen']
+        with _ledger_lock:
+            conn = _ledger_conn()
+            with conn:
+                conn.executemany(f"INSERT OR REPLACE INTO snapshot_harian (hari, {', '.join(kolom)}) VALUES (?{', ?' * len(kolom)})",
+                                 [(hari,) + tuple(row) for row in df[kolom].itertuples(index=False, name=None)])
+    print(f"Snapshot harian {hari}: {len(df)} pengguna.")
+    return len(df)
+
+def _snapshot_loop():
+    while True:
+        try:
+            sekarang = datetime.datetime.now(datetime.timezone.utc)
+            hari = sekarang.strftime('%Y-%m-%d')
+            if sekarang.hour >= DAILY_SNAPSHOT_HOUR_UTC and _snapshot_state["hari_terakhir"] != hari:
+                # Jika harga sedang tidak tersedia, dicoba lagi pada putaran berikutnya
+                if take_daily_snapshot(hari) is not None:
+                    _snapshot_state["hari_terakhir"] = hari
+        except Exception:
+            traceback.print_exc()
+        time.sleep(SNAPSHOT_CHECK_INTERVAL)
+
+def start_snapshot_job():
+    """Menjalankan tugas snapshot harian sekali per proses, dan hanya di satu proses (file lock seperti poller peringatan)."""
+    if SNAPSHOT_CHECK_INTERVAL <= 0:
+        return
+    with _snapshot_lock:
+        if _snapshot_state["pid"] == os.getpid():
+            return
+        _snapshot_state["pid"] = os.getpid()
+        if not _acquire_leader_lock("snapshot"):
+            return
+        with _ledger_lock:
+            _snapshot_state["hari_terakhir"] = _ledger_conn().execute("SELECT MAX(hari) FROM snapshot_harian").fetchone()[0]
+    threading.Thread(target=_snapshot_loop, name="daily-snapshot", daemon=True).start()
+    print("Tugas snapshot harian berjalan.")
+
 # ==============================================================================
 # BAGIAN 3: FUNGSI KOMUNIKASI TELEGRAM
 # ==============================================================================
 
-def send_telegram_message(chat_id, message_text):
-    """Mengirim pesan teks ke pengguna melalui Telegram Bot API."""
+# --- Antrean keluar: pesan per chat digabung, laju dibatasi, retry_after dari Telegram dipatuhi ---
+
+_outbox_cond = threading.Condition()
+_outbox = OrderedDict()   # chat_id -> deque of ("teks", text) / ("aksi", fn -> retry_after|None); urutan dict = giliran round-robin
+_outbox_state = {"pid": None, "ready_at": {}, "in_flight": set()}
+
+_rate_lock = threading.Lock()
+_rate_bucket = {"tokens": TELEGRAM_GLOBAL_RATE, "updated": time.monotonic(), "paused_until": 0.0}
+
+def _take_rate_token():
+    """Token bucket global: menunggu sampai boleh mengirim satu permintaan ke Telegram."""
+    while True:
+        with _rate_lock:
+            now = time.monotonic()
+            _rate_bucket["tokens"] = min(TELEGRAM_GLOBAL_RATE, _rate_bucket["tokens"] + (now - _rate_bucket["updated"]) * TELEGRAM_GLOBAL_RATE)
+            _rate_bucket["updated"] = now
+            jeda = _rate_bucket["paused_until"] - now
+            if jeda <= 0:
+                if _rate_bucket["tokens"] >= 1:
+                    _rate_bucket["tokens"] -= 1
+                    return
+                jeda = (1 - _rate_bucket["tokens"]) / TELEGRAM_GLOBAL_RATE
+        time.sleep(jeda)
+
+def _pause_rate(detik):
+    with _rate_lock:
+        _rate_bucket["paused_until"] = max(_rate_bucket["paused_until"], time.monotonic() + detik)
+
+def _telegram_retry_after(e):
+    """retry_after (detik) dari HTTPError 429 Telegram, atau None untuk kegagalan lain."""
+    if e.response is None or e.response.status_code != 429:
+        return None
+    try:
+        return float(e.response.json().get('parameters', {}).get('retry_after', 1))
+    except ValueError:
+        return 1.0
+
+def _post_message(chat_id, message_text):
+    """Mengirim satu sendMessage. Mengembalikan retry_after (detik) jika Telegram membalas 429, selain itu None."""
     url = f"{TELEGRAM_API_URL}/sendMessage"
     # Menggunakan parse_mode='Markdown' agar format tebal (*...*) bisa berfungsi
     data = {"chat_id": chat_id, "text": message_text, "parse_mode": "Markdown"}
     try:
-        response = requests.post(url, json=data)
-        response.raise_for_status()
+        # 429 ditangani oleh dispatcher, bukan oleh retry http_request
+        with ukur("telegram_send"):
+            http_request('post', url, idempotent=False, max_retries=0, json=data)
         print(f"Berhasil mengirim balasan teks ke chat_id: {chat_id}")
+    except requests.exceptions.HTTPError as e:
+        retry_after = _telegram_retry_after(e)
+        if retry_after is not None:
+            return retry_after
+        print(f"Gagal mengirim balasan teks: {e}")
     except requests.exceptions.RequestException as e:
         print(f"Gagal mengirim balasan teks: {e}")
+    return None
 
-def send_telegram_photo(chat_id, photo_path, caption=""):
-    """Mengirim gambar ke pengguna melalui Telegram Bot API."""
-    url = f"{TELEGRAM_API_URL}/sendPhoto"
-    with open(photo_path, 'rb') as photo_file:
-        files = {'photo': photo_file}
-        data = {'chat_id': chat_id, 'caption': caption}
+def _next_outbound():
+    """Mengambil kiriman berikutnya dari chat yang sudah boleh dikirimi; teks berurutan digabung jadi satu."""
+    with _outbox_cond:
+        while True:
+            now = time.monotonic()
+            tunggu = None
+            for chat_id, items in _outbox.items():
+                if chat_id in _outbox_state["in_flight"]:
+                    continue
+                ready_at = _outbox_state["ready_at"].get(chat_id, 0)
+                if ready_at > now:
+                    tunggu = min(tunggu or ready_at - now, ready_at - now)
+                    continue
+                _outbox.move_to_end(chat_id)
+                item = items.popleft()
+                if item[0] == "teks":
+                    teks = item[1]
+                    while items and items[0][0] == "teks" and len(teks) + 2 + len(items[0][1]) <= TELEGRAM_MESSAGE_LIMIT:
+                        teks += "\n\n" + items.popleft()[1]
+                    item = ("teks", teks)
+                if not items:
+                    del _outbox[chat_id]
+                _outbox_state["in_flight"].add(chat_id)
+                return chat_id, item
+            _outbox_cond.wait(timeout=tunggu)
+
+def _dispatcher_loop():
+    while True:
+        chat_id, item = _next_outbound()
+        jeda = TELEGRAM_CHAT_INTERVAL
         try:
-            response = requests.post(url, files=files, data=data)
-            response.raise_for_status()
-            print(f"Pesan gambar berhasil dikirim ke chat_id: {chat_id}")
-        except requests.exceptions.RequestException as e:
-            print(f"Gagal mengirim pesan gambar: {e}")
+            _take_rate_token()
+            if item[0] == "teks":
+                retry_after = _post_message(chat_id, item[1])
+            else:
+                retry_after = item[1]()
+            if retry_after is not None:
+                print(f"Telegram meminta jeda {retry_after:.0f} detik (chat_id: {chat_id}).")
+                _pause_rate(retry_after)
+                jeda = retry_after
+                _enqueue_outbound(chat_id, item, front=True)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with _outbox_cond:
+                _outbox_state["in_flight"].discard(chat_id)
+                _outbox_state["ready_at"][chat_id] = time.monotonic() + jeda
+                _outbox_cond.notify_all()
+
+def _ensure_dispatcher():
+    """Menjalankan thread pengirim sekali per proses (aman setelah fork)."""
+    with _outbox_cond:
+        if _outbox_state["pid"] == os.getpid():
+            return
+        _outbox_state["pid"] = os.getpid()
+        for nomor in range(TELEGRAM_SENDER_THREADS):
+            threading.Thread(target=_dispatcher_loop, name=f"telegram-sender-{nomor}", daemon=True).start()
+
+def _enqueue_outbound(chat_id, item, front=False):
+    _ensure_dispatcher()
+    with _outbox_cond:
+        # Bersihkan jadwal chat yang sudah lewat agar dict tidak terus membesar
+        now = time.monotonic()
+        for lama in [c for c, t in _outbox_state["ready_at"].items() if t < now and c not in _outbox]:
+            del _outbox_state["ready_at"][lama]
+        items = _outbox.setdefault(chat_id, deque())
+        if front:
+            items.appendleft(item)
+        else:
+            items.append(item)
+        _outbox_cond.notify_all()
+
+def flush_outbox(timeout=None):
+    """Menunggu sampai semua pesan di antrean terkirim; False jika timeout."""
+    batas = None if timeout is None else time.monotonic() + timeout
+    with _outbox_cond:
+        while _outbox or _outbox_state["in_flight"]:
+            sisa = None if batas is None else batas - time.monotonic()
+            if sisa is not None and sisa <= 0:
+                return False
+            _outbox_cond.wait(timeout=sisa if sisa is not None else 1.0)
+    return True
+
+def send_telegram_message(chat_id, message_text):
+    """Memasukkan pesan teks ke antrean kirim chat_id (tidak menunggu terkirim)."""
+    # Pesan yang terlalu panjang dipecah per baris agar tidak melebihi batas Telegram
+    for bagian in split_message(message_text.split("\n"), separator="\n"):
+        _enqueue_outbound(chat_id, ("teks", bagian))
+
+def send_telegram_photo(chat_id, photo, caption=""):
+    """Mengirim gambar ke pengguna melalui Telegram Bot API.
+
+    `photo` berupa bytes PNG (diunggah) atau file_id Telegram (tanpa unggah ulang).
+    Mengembalikan (file_id, retry_after): file_id gambar yang terkirim (None jika gagal), dan
+    retry_after dalam detik jika Telegram membalas 429 sehingga dispatcher yang menjeda dan mengulang.
+    """
+    url = f"{TELEGRAM_API_URL}/sendPhoto"
+    data = {'chat_id': chat_id, 'caption': caption}
+    files = None
+    if isinstance(photo, bytes):
+        files = {'photo': ('grafik_investasi.png', photo, 'image/png')}
+    else:
+        data['photo'] = photo
+    try:
+        with ukur("upload" if files else "telegram_send"):
+            # 429 ditangani oleh dispatcher, bukan oleh retry http_request
+            response = http_request('post', url, idempotent=False, max_retries=0, files=files, data=data)
+        print(f"Pesan gambar berhasil dikirim ke chat_id: {chat_id}")
+        # Telegram mengembalikan beberapa ukuran; yang terakhir adalah resolusi terbesar
+        return response.json()['result']['photo'][-1]['file_id'], None
+    except requests.exceptions.HTTPError as e:
+        retry_after = _telegram_retry_after(e)
+        if retry_after is not None:
+            return None, retry_after
+        print(f"Gagal mengirim pesan gambar: {e}")
+    except requests.exceptions.RequestException as e:
+        print(f"Gagal mengirim pesan gambar: {e}")
+    except (KeyError, IndexError, ValueError):
+        print("Gambar terkirim, tetapi file_id tidak ditemukan dalam respons Telegram.")
+    return None, None
+
+def send_chart(chat_id, chart_data, caption):
+    """Mengirim grafik lewat antrean (urutan dengan pesan teks terjaga); memakai file_id jika grafik sudah pernah diunggah."""
+    def kirim():
+        # Mengembalikan retry_after agar dispatcher menjeda bucket dan mengantrekan ulang kiriman ini di depan
+        if chart_data.get('file_id'):
+            file_id, retry_after = send_telegram_photo(chat_id, chart_data['file_id'], caption=caption)
+            if retry_after is not None:
+                return retry_after
+            if file_id:
+                inc("bot_cache_total", cache="telegram_file_id", result="hit")
+                return None
+        inc("bot_cache_total", cache="telegram_file_id", result="miss")
+        file_id, retry_after = send_telegram_photo(chat_id, chart_data['png'], caption=caption)
+        if file_id:
+            remember_chart_file_id(chart_data['cache_key'], file_id)
+        return retry_after
+    _enqueue_outbound(chat_id, ("aksi", kirim))
 
 # ==============================================================================
 # BAGIAN 4: SERVER WEBHOOK FLASK (UNTUK TELEGRAM)
 # ==============================================================================
 
-@app.route('/webhook', methods=['POST'])
-def webhook():
-    data = request.get_json()
+def _parse_window(args, default=30):
+    """Jendela hari dari argumen perintah (mis. 'prediksi 90'), dibatasi CANDLE_BACKFILL_DAYS."""
+    if len(args) == 1 and args[0].isdigit():
+        return min(max(int(args[0]), 2), CANDLE_BACKFILL_DAYS)
+    return default
+
+def _command_label(message_body):
+    """Nama perintah yang dipakai sebagai label metrik (tanpa argumen)."""
+    kata = message_body.split()
+    if not kata:
+        return "kosong"
+    if kata[0] == 'cek' and len(kata) > 1:
+        return f"cek_{kata[1]}"
+    if kata[0] in ('dca', 'grafik', 'status', 'alert', 'prediksi', 'impor', 'sinkron'):
+        return kata[0]
+    return "lainnya"
+
+def process_update(data):
+    """Memproses satu update sambil mengukur durasinya; update yang lambat dicatat sebagai log terstruktur."""
+    message = data.get('message', {})
+    perintah = _command_label((message.get('text') or message.get('caption') or '').lower())
+    _update_context.tahap = {}
+    mulai = time.perf_counter()
+    try:
+        _handle_update(data)
+    finally:
+        durasi = time.perf_counter() - mulai
+        tahap, _update_context.tahap = _update_context.tahap, None
+        observe("bot_update_seconds", durasi, command=perintah)
+        if durasi >= SLOW_UPDATE_SECONDS:
+            print(json.dumps({
+                "event": "slow_update",
+                "update_id": data.get('update_id'),
+                "chat_id": message.get('chat', {}).get('id'),
+                "command": perintah,
+                "duration_s": round(durasi, 3),
+                "stages_s": {nama: round(nilai, 3) for nama, nilai in tahap.items()},
+            }))
+
+def _handle_update(data):
+    """Menjalankan perintah dari satu update Telegram (dipanggil oleh worker, bukan oleh request HTTP)."""
     try:
         # 1. Ekstrak informasi penting dari data Telegram
-        if 'message' in data and 'text' in data['message']:
+        if 'message' in data and ('text' in data['message'] or 'caption' in data['message']):
             chat_id = data['message']['chat']['id']
-            message_body = data['message']['text'].lower()
+            message_body = (data['message'].get('text') or data['message']['caption']).lower()
 
             print(f"Pesan dari: {chat_id} | Isi: {message_body}")
 
@@ -334,23 +1786,21 @@ def webhook():
                     send_telegram_message(chat_id, f"Memproses permintaan DCA sebesar Rp {jumlah_dca:,.0f}...")
 
                     # --- Proses dan catat DCA (logika ini tidak berubah) ---
-                    harga_btc_usd = get_btc_price_from_binance()
-                    kurs_usd_idr = get_usd_to_idr_rate()
-                    harga_final_btc_idr = harga_btc_usd * kurs_usd_idr
+                    harga_final_btc_idr, harga_stale = get_btc_idr_price()
+                    if harga_final_btc_idr is None:
+                        send_telegram_message(chat_id, "Gagal mengambil harga BTC atau kurs IDR. Deposit belum dicatat, silakan coba lagi.")
+                        return
                     jumlah_btc_didapat = jumlah_dca / harga_final_btc_idr
                     
-                    sheet = setup_google_sheets()
                     tanggal_hari_ini = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    sheet.append_row([tanggal_hari_ini, jumlah_dca, harga_final_btc_idr, jumlah_btc_didapat])
+                    record_deposit(chat_id, tanggal_hari_ini, jumlah_dca, harga_final_btc_idr, jumlah_btc_didapat)
                     
-                    # ... (logika perhitungan keuntungan tetap sama) ...
-                    all_btc_values = sheet.col_values(4) 
-                    total_btc_owned = sum([float(str(i).replace(',', '.')) for i in all_btc_values[1:]])
-                    all_modal_values = sheet.col_values(2)
-                    total_modal = sum([float(str(i).replace(',', '.')) for i in all_modal_values[1:]])
-                    nilai_aset = total_btc_owned * harga_final_btc_idr
-                    keuntungan_rp = nilai_aset - total_modal
-                    keuntungan_persen = (keuntungan_rp / total_modal) * 100 if total_modal > 0 else 0
+                    # Total dibaca dari agregat ledger, tanpa menjumlahkan ulang seluruh riwayat
+                    totals = get_ledger_totals(chat_id)
+                    total_btc_owned = totals['total_btc']
+                    summary = portfolio_summary(totals, harga_final_btc_idr)
+                    keuntungan_rp = summary['keuntungan_rp']
+                    keuntungan_persen = summary['keuntungan_persen']
                     
                     # --- Kirim Jawaban Teks (menggunakan fungsi Telegram) ---
                     balasan_sukses = (
@@ -359,15 +1809,18 @@ def webhook():
                         f"Harga BTC: Rp {harga_final_btc_idr:,.2f}\n"
                         f"BTC Didapat: `{jumlah_btc_didapat:.8f}` BTC\n\n" # Gunakan `...` untuk format monospaced di Telegram
                         f"Total Aset Anda: *{total_btc_owned:.8f} BTC*\n"
+                        f"Harga Rata-rata: Rp {totals['harga_rata_rata']:,.0f} ({totals['jumlah_deposit']} deposit)\n"
                         f"*Akumulasi Riwayat Keuntungan Anda: Rp {keuntungan_rp:,.2f} ({keuntungan_persen:.1f}%)*"
                     )
+                    if harga_stale:
+                        balasan_sukses += STALE_NOTE
                     send_telegram_message(chat_id, balasan_sukses)
 
                     # --- Kirim Jawaban Grafik (menggunakan fungsi Telegram) ---
                     send_telegram_message(chat_id, "Membuat dasbor grafik terbaru...")
-                    chart_data = create_and_save_chart()  # Pastikan menerima stats yang benar
+                    chart_data = create_chart(chat_id)
                     if chart_data:
-                        send_telegram_photo(chat_id, chart_data['filename'], caption="Berikut dasbor investasi Anda.")
+                        send_chart(chat_id, chart_data, caption="Berikut dasbor investasi Anda.")
                     else:
                         send_telegram_message(chat_id, "Maaf, data investasi belum cukup untuk membuat grafik.")
                 else:
@@ -377,10 +1830,10 @@ def webhook():
                 send_telegram_message(chat_id, "Sedang membuat dasbor grafik Anda, mohon tunggu sebentar...")
 
                 # --- PERUBAHAN DI SINI: Menangkap data statistik ---
-                chart_data = create_and_save_chart()
+                chart_data = create_chart(chat_id)
                 if chart_data:
-                    # Kirim foto terlebih dahulu, pastikan mengambil 'filename' dari chart_data
-                    send_telegram_photo(chat_id, chart_data['filename'], caption="Berikut dasbor investasi Anda.")
+                    # Kirim foto terlebih dahulu
+                    send_chart(chat_id, chart_data, caption="Berikut dasbor investasi Anda.")
                     
                     # Buat dan kirim pesan ringkasan
                     keuntungan_rp = chart_data['keuntungan_rp']
@@ -397,67 +1850,243 @@ def webhook():
             
             # Fitur tambahan untuk peringatan harga BTC
             elif message_body == 'cek harga':
-                harga_btc_usd = get_btc_price_from_binance()  # Inisialisasi di luar blok if
-                if harga_btc_usd is None:
-                    send_telegram_message(chat_id, "Gagal mengambil harga BTC.")
-                    return Response(status=200)
-                kurs_usd_idr = get_usd_to_idr_rate()
-                if kurs_usd_idr is None:
-                    send_telegram_message(chat_id, "Gagal mengambil kurs IDR.")
-                    return Response(status=200)
-                harga_btc_idr = harga_btc_usd * kurs_usd_idr
-
-                target_prices = [2000000000, 2500000000, 3000000000, 3500000000, 4000000000, 
-                                 4500000000, 5000000000, 5500000000, 6000000000, 6500000000, 
-                                 7000000000, 7500000000, 8000000000, 8500000000, 9000000000, 
-                                 9500000000, 10000000000, 10500000000, 11000000000, 11500000000, 
-                                 12000000000, 12500000000, 13000000000, 13500000000, 14000000000, 
-                                 14500000000, 15000000000, 15500000000, 16000000000, 16500000000, 
-                                 17000000000, 17500000000, 18000000000, 18500000000, 19000000000, 
-                                 20000000000]
-                
-                targets_reached = [target for target in target_prices if harga_btc_idr >= target]
-                
-                if targets_reached:
-                    for target in targets_reached:
-                        send_telegram_message(chat_id, f"🚨 Peringatan! Harga BTC mencapai target Rp {target:,}.\nSaat ini harga BTC: Rp {harga_btc_idr:,.0f}")
+                harga_btc_idr, harga_stale = get_btc_idr_price()
+                if harga_btc_idr is None:
+                    send_telegram_message(chat_id, "Gagal mengambil harga BTC atau kurs IDR.")
+                    return
+                catatan = STALE_NOTE if harga_stale else ""
+
+                target_prices = get_alert_targets(chat_id) or DEFAULT_TARGET_PRICES
+                # Cukup satu pesan: target tertinggi yang tercapai dan target berikutnya
+                posisi = bisect.bisect_right(target_prices, harga_btc_idr)
+                pesan = f"Harga BTC saat ini: Rp {harga_btc_idr:,.0f}\n"
+                if posisi > 0:
+                    pesan += f"🚨 Target tertinggi yang tercapai: Rp {target_prices[posisi - 1]:,.0f} ({posisi} dari {len(target_prices)} target).\n"
                 else:
-                    send_telegram_message(chat_id, f"Harga BTC saat ini: Rp {harga_btc_idr:,.0f}\nBelum mencapai target apa pun.")
+                    pesan += "Belum mencapai target apa pun.\n"
+                if posisi < len(target_prices):
+                    pesan += f"Target berikutnya: Rp {target_prices[posisi]:,.0f}"
+                send_telegram_message(chat_id, pesan.rstrip() + catatan)
+
+            elif message_body == 'alert' or message_body.startswith('alert '):
+                parts = message_body.split()
+                if len(parts) == 3 and parts[1] in ('tambah', 'hapus') and parts[2].isdigit():
+                    set_alert_target(chat_id, int(parts[2]), aktif=parts[1] == 'tambah')
+                    aksi = "ditambahkan" if parts[1] == 'tambah' else "dihapus"
+                    send_telegram_message(chat_id, f"Peringatan Rp {int(parts[2]):,} {aksi}.")
+                elif len(parts) == 1 or parts[1] == 'daftar':
+                    targets = get_alert_targets(chat_id)
+                    if targets:
+                        send_telegram_message(chat_id, "Peringatan aktif:\n" + "\n".join(f"- Rp {target:,.0f}" for target in targets))
+                    else:
+                        send_telegram_message(chat_id, "Belum ada peringatan. Gunakan: alert tambah [harga]")
+                else:
+                    send_telegram_message(chat_id, "Format salah. Gunakan: alert [daftar|tambah|hapus] [harga]\nContoh: alert tambah 2500000000")
                     
-            elif message_body == 'status':
-                status_message = get_portfolio_status()
-                send_telegram_message(chat_id, status_message)
+            elif message_body == 'status' or message_body.startswith('status '):
+                parts = message_body.split()
+                halaman = int(parts[1]) if len(parts) == 2 and parts[1].isdigit() else 1
+                for status_message in get_portfolio_status(chat_id, halaman):
+                    send_telegram_message(chat_id, status_message)
             
-            elif message_body == 'cek volatilitas':
-                vol = get_btc_volatility()
+            elif message_body.startswith('impor'):
+                # Baris deposit bisa ditulis setelah kata 'impor' atau dikirim sebagai dokumen CSV berketerangan 'impor'
+                isi = message_body[len('impor'):]
+                document = data['message'].get('document')
+                if document:
+                    try:
+                        isi += "\n" + download_telegram_file(document['file_id'])
+                    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                        print(f"Gagal mengunduh berkas impor: {e}")
+                        send_telegram_message(chat_id, "Gagal mengunduh berkas impor.")
+                        return
+                import_deposits(chat_id, isi)
+
+            elif message_body == 'sinkron':
+                sync_ledger(chat_id, full=True)
+                send_telegram_message(chat_id, "Ledger lokal sudah disinkronkan ulang dengan Google Sheets.")
+
+            elif message_body.startswith('cek volatilitas'):
+                days = _parse_window(message_body.split()[2:])
+                vol = get_btc_volatility(days)
                 if vol is None:
                     send_telegram_message(chat_id, "Gagal menghitung volatilitas.")
                 else:
                     threshold = 50  # Ubah sesuai kebutuhan
                     if vol > threshold:
-                        msg = f"🚨 Alert! Volatilitas BTC tinggi: {vol:.2f}% (30 hari annualized). Ini berisiko (negatif) untuk investor konservatif karena ketidakpastian harga, tapi menguntungkan (positif) bagi trader yang mencari peluang fluktuasi cepat."
+                        msg = f"🚨 Alert! Volatilitas BTC tinggi: {vol:.2f}% ({days} hari annualized). Ini berisiko (negatif) untuk investor konservatif karena ketidakpastian harga, tapi menguntungkan (positif) bagi trader yang mencari peluang fluktuasi cepat."
                     else:
-                        msg = f"Volatilitas BTC: {vol:.2f}% (30 hari annualized). Volatilitas rendah ini relatif positif untuk stabilitas investasi jangka panjang, meski tetap ada risiko inheren di crypto."
+                        msg = f"Volatilitas BTC: {vol:.2f}% ({days} hari annualized). Volatilitas rendah ini relatif positif untuk stabilitas investasi jangka panjang, meski tetap ada risiko inheren di crypto."
                     send_telegram_message(chat_id, msg)
                     
-            elif message_body == 'prediksi':
-                prediksi = get_crypto_prediction_from_polygon()
+            elif message_body.startswith('prediksi'):
+                prediksi = get_crypto_prediction_from_polygon(_parse_window(message_body.split()[1:]))
                 if prediksi:
                     send_telegram_message(chat_id, prediksi)
                 else:
                     send_telegram_message(chat_id, "Gagal mengambil prediksi dari Polygon.io.")
             
             else:
-                send_telegram_message(chat_id, "Perintah tidak dikenali. Gunakan 'dca [jumlah]', 'grafik', 'status', 'cek harga', 'cek volatilitas', atau 'prediksi'.")
+                send_telegram_message(chat_id, "Perintah tidak dikenali. Gunakan 'dca [jumlah]', 'grafik', 'status [halaman]', 'cek harga', 'alert [daftar|tambah|hapus] [harga]', 'cek volatilitas [hari]', 'prediksi [hari]', 'impor', atau 'sinkron'.")
 
     except Exception as e:
         print(f"Error memproses pesan. Laporan Eror Lengkap:")
         traceback.print_exc()
 
+# --- Idempotensi: setiap update_id hanya diproses sekali, juga setelah restart ---
+
+_processed_lock = threading.Lock()
+_processed_updates = OrderedDict()   # update_id -> waktu; cache cepat di depan tabel SQLite
+
+def _evict_processed_updates(now):
+    """Membuang penanda yang melewati TTL atau melebihi kapasitas."""
+    while _processed_updates:
+        update_id, waktu = next(iter(_processed_updates.items()))
+        if now - waktu < PROCESSED_UPDATE_TTL and len(_processed_updates) <= PROCESSED_UPDATE_MAX:
+            break
+        _processed_updates.popitem(last=False)
+
+def claim_update(update_id):
+    """Menandai update_id sebagai diproses; False jika sudah pernah ditandai (pengiriman ulang)."""
+    now = time.time()
+    with _processed_lock:
+        if update_id in _processed_updates:
+            return False
+        with _ledger_lock:
+            conn = _ledger_conn()
+            with conn:
+                baru = conn.execute("INSERT OR IGNORE INTO update_diproses (update_id, waktu) VALUES (?, ?)",
+                                    (update_id, now)).rowcount == 1
+                # Pembersihan berkala agar tabel tetap kecil
+                if baru and update_id % 100 == 0:
+                    conn.execute("DELETE FROM update_diproses WHERE waktu < ?", (now - PROCESSED_UPDATE_TTL,))
+        _processed_updates[update_id] = now
+        _evict_processed_updates(now)
+        return baru
+
+def release_update(update_id):
+    """Menghapus penanda agar update yang tidak jadi diproses bisa diterima lagi saat dikirim ulang."""
+    with _processed_lock:
+        _processed_updates.pop(update_id, None)
+        with _ledger_lock:
+            conn = _ledger_conn()
+            with conn:
+                conn.execute("DELETE FROM update_diproses WHERE update_id = ?", (update_id,))
+
+# --- Antrean update: webhook langsung membalas 200, perintah diproses oleh worker ---
+
+_worker_lock = threading.Lock()
+_worker_state = {"pid": None, "queues": []}
+
+def _worker_loop(update_queue):
+    while True:
+        data = update_queue.get()
+        try:
+            process_update(data)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            update_queue.task_done()
+
+def _ensure_workers():
+    """Menjalankan thread worker sekali per proses (aman setelah fork oleh gunicorn)."""
+    with _worker_lock:
+        if _worker_state["pid"] == os.getpid():
+            return
+        queues = [queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE) for _ in range(WEBHOOK_WORKERS)]
+        for nomor, update_queue in enumerate(queues):
+            threading.Thread(target=_worker_loop, args=(update_queue,), name=f"webhook-worker-{nomor}", daemon=True).start()
+        _worker_state["queues"] = queues
+        _worker_state["pid"] = os.getpid()
+
+def enqueue_update(chat_id, data):
+    """Memasukkan update ke antrean worker milik chat_id; False jika antrean penuh.
+
+    Setiap chat selalu dipetakan ke worker yang sama sehingga urutan perintah per chat terjaga.
+    """
+    _ensure_workers()
+    queues = _worker_state["queues"]
+    try:
+        queues[hash(chat_id) % len(queues)].put_nowait(data)
+        return True
+    except queue.Full:
+        return False
+
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return Response(status=400)
+
+    # Update tanpa pesan teks (atau dokumen berketerangan) tidak perlu diproses
+    message = data.get('message')
+    if not isinstance(message, dict) or not (message.get('text') or message.get('caption')) or 'id' not in message.get('chat', {}):
+        return Response(status=200)
+
+    # Hanya chat yang terdaftar; pesan lain dijawab 200 agar Telegram tidak mengirim ulang
+    if message['chat']['id'] not in AUTHORIZED_USER_IDS:
+        print(f"Pesan dari chat_id {message['chat']['id']} yang tidak terdaftar diabaikan.")
+        inc("bot_updates_total", result="unauthorized")
+        return Response(status=200)
+
+    # Pengiriman ulang dari Telegram langsung dijawab tanpa memanggil Binance, ER-API, atau Sheets
+    update_id = data.get('update_id')
+    if isinstance(update_id, int) and not claim_update(update_id):
+        print(f"Update {update_id} sudah pernah diproses, diabaikan.")
+        inc("bot_updates_total", result="duplicate")
+        return Response(status=200)
+
+    if not enqueue_update(message['chat']['id'], data):
+        if WEBHOOK_OVERFLOW_POLICY == 'drop':
+            print(f"Antrean penuh, update {data.get('update_id')} dibuang.")
+            inc("bot_updates_total", result="dropped")
+            return Response(status=200)
+        # Kebijakan 'retry': Telegram akan mengirim ulang update ini nanti
+        if isinstance(update_id, int):
+            release_update(update_id)
+        print(f"Antrean penuh, update {data.get('update_id')} diminta dikirim ulang.")
+        inc("bot_updates_total", result="rejected")
+        return Response(status=503)
+
+    inc("bot_updates_total", result="queued")
     return Response(status=200)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    with _outbox_cond:
+        outbox_depth = sum(len(items) for items in _outbox.values())
+    gauges = {
+        "bot_webhook_queue_depth": sum(q.qsize() for q in _worker_state["queues"]),
+        "bot_outbox_depth": outbox_depth,
+    }
+    return Response(render_metrics(gauges), mimetype='text/plain; version=0.0.4')
+
+# --- Pemanasan sebelum fork (gunicorn preload_app, lihat gunicorn.conf.py) ---
+
+def warm_up():
+    """Menyiapkan pustaka berat, klien & worksheet Sheets, cache harga, dan template grafik sekali di proses master.
+
+    Worker hasil fork mewarisinya secara copy-on-write. SQLite, thread worker, dan sesi HTTP
+    sengaja tidak dibuka di sini; semuanya dibuat per proses saat pertama kali dipakai.
+    """
+    mulai = time.perf_counter()
+    import pandas, numpy  # noqa: F401  (dimuat agar halaman modulnya dibagi ke semua worker)
+    try:
+        for chat_id in AUTHORIZED_USER_IDS:
+            setup_google_sheets(chat_id)
+    except Exception as e:
+        print(f"Pemanasan: otorisasi Google Sheets gagal, worker akan mencoba lagi. Error: {e}")
+    for nama in _QUOTE_FETCHERS:
+        get_quote(nama)
+    with _chart_lock:
+        if not _chart_template:
+            _chart_template.update(_build_chart_template())
+    print(f"Pemanasan selesai dalam {time.perf_counter() - mulai:.2f} detik.")
     
 # ==============================================================================
 # BAGIAN 5: MENJALANKAN SERVER
 # ==============================================================================
 if __name__ == "__main__":
+    start_alert_poller()
+    start_snapshot_job()
     app.run(port=5000)
@@ -0,0 +1,29 @@
+# Konfigurasi gunicorn (dibaca otomatis): gunicorn bot_server_final_fix:app
+#
+# BOT_WARMUP=1 mengaktifkan pemanasan sebelum fork: modul bot diimpor dan warm_up() dijalankan
+# sekali di master (pustaka berat, otorisasi Sheets, cache harga, template grafik), lalu
+# worker mewarisinya secara copy-on-write sehingga respons pertama setelah deploy lebih cepat.
+# Tanpa BOT_WARMUP, setiap worker memuat semuanya sendiri saat pertama kali dibutuhkan.
+import os
+
+preload_app = os.environ.get("BOT_WARMUP", "0") == "1"
+
+def when_ready(server):
+    # Dengan preload_app, aplikasi sudah diimpor di master sebelum hook ini dan sebelum fork
+    if preload_app:
+        import bot_server_final_fix
+        bot_server_final_fix.warm_up()
+
+def post_fork(server, worker):
+    # Sesi HTTP, thread worker, dan dispatcher dibuat ulang per proses, dan warm_up tidak membuka SQLite;
+    # yang tersisa hanya koneksi Sheets milik master
+    if preload_app:
+        import bot_server_final_fix
+        bot_server_final_fix.release_inherited_connections()
+
+def post_worker_init(worker):
+    # Poller peringatan dan snapshot harian dijalankan saat worker siap, bukan menunggu webhook pertama;
+    # file lock di masing-masing fungsi start memastikan hanya satu worker yang menjalankannya
+    import bot_server_final_fix
+    bot_server_final_fix.start_alert_poller()
+    bot_server_final_fix.start_snapshot_job()
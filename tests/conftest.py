@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# Modul bot membaca konfigurasi dari environment saat diimpor
+os.environ.setdefault("TELEGRAM_TOKEN", "test")
+os.environ.setdefault("AUTHORIZED_USER_ID", "1")
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(tempfile.mkdtemp(), "bot_cache.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
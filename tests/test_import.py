@@ -0,0 +1,120 @@
+import datetime
+
+import pytest
+
+import bot_server_final_fix as bot
+
+
+def test_parse_import_custom_format():
+    deposits, errors = bot.parse_import(
+        "tanggal jumlah harga\n"
+        "2024-01-03 10:15 100000\n"
+        "2024-01-04,200000,650000000\n"
+        "\n"
+        "2024-13-01 5000\n"
+        "2024-01-05 -1\n")
+    assert deposits == [
+        (datetime.datetime(2024, 1, 3, 10, 15), 100000.0, None),
+        (datetime.datetime(2024, 1, 4), 200000.0, 650000000.0),
+    ]
+    assert errors == ["Baris 5: tanggal tidak dikenali: 2024-13-01", "Baris 6: jumlah dan harga harus positif"]
+
+
+def test_parse_import_exchange_csv():
+    deposits, errors = bot.parse_import(
+        "Date(UTC),Pair,Side,Price,Executed,Amount,Fee\n"
+        '2024-01-03 10:11:12,BTCIDR,BUY,"650,000,000.00",0.00153846BTC,"1,000,000.00IDR",0.00000153BTC\n'
+        "2024-01-04 09:00:00,BTCIDR,SELL,660000000,0.001BTC,660000IDR,660IDR\n"
+        "2024-01-05 09:00:00,BTCUSDT,BUY,42000,0.001BTC,42USDT,0.042USDT\n")
+    assert deposits == [(datetime.datetime(2024, 1, 3, 10, 11, 12), 1000000.0, 650000000.0)]
+    assert errors == ["Baris 3: bukan transaksi beli (SELL)", "Baris 4: pasangan BTCUSDT tidak didukung, hanya BTC/IDR"]
+
+
+def test_price_deposits_uses_candles_for_past_days(monkeypatch):
+    hari_ini = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    monkeypatch.setattr(bot, "get_usd_to_idr_rate", lambda: 16000.0)
+    monkeypatch.setattr(bot, "get_btc_idr_price", lambda: (1_000_000_000.0, False))
+    diminta = []
+    def candle_closes(sumber, hari):
+        diminta.append((sumber, sorted(hari)))
+        return {"2024-01-03": 40000.0}
+    monkeypatch.setattr(bot, "candle_closes_for_days", candle_closes)
+
+    rows, errors = bot.price_deposits([
+        (hari_ini, 500000.0, None),
+        (datetime.datetime(2024, 1, 3, 10), 640000.0, None),
+        (datetime.datetime(2024, 1, 2), 100000.0, 500000000.0),
+        (datetime.datetime(2024, 1, 1), 100000.0, None),
+    ])
+
+    assert diminta == [("binance", ["2024-01-01", "2024-01-03"])]
+    assert errors == ["2024-01-01: harga tidak tersedia"]
+    assert rows == [
+        ("2024-01-02 00:00:00", 100000.0, 500000000.0, pytest.approx(0.0002)),
+        ("2024-01-03 10:00:00", 640000.0, 640000000.0, pytest.approx(0.001)),
+        (hari_ini.strftime("%Y-%m-%d %H:%M:%S"), 500000.0, 1_000_000_000.0, pytest.approx(0.0005)),
+    ]
+
+
+@pytest.mark.parametrize("response, nomor", [
+    ({"updates": {"updatedRange": "Sheet1!A5:D9"}}, 5),
+    ({"updates": {"updatedRange": "'123456'!A12:D12"}}, 12),
+    ({"updates": {}}, None),
+    (None, None),
+])
+def test_row_number_from_update(response, nomor):
+    assert bot._row_number_from_update(response) == nomor
+
+
+class FakeSheet:
+    def __init__(self, values):
+        self.values = values   # baris 1 = judul kolom
+
+    def append_rows(self, rows):
+        mulai = len(self.values) + 1
+        self.values.extend(rows)
+        return {"updates": {"updatedRange": f"Sheet1!A{mulai}:D{len(self.values)}"}}
+
+    def get(self, rentang):
+        mulai, akhir = (int(bagian[1:]) for bagian in rentang.split(":"))
+        return self.values[mulai - 1:akhir]
+
+
+def test_record_deposits_reads_rows_added_by_hand(monkeypatch):
+    chat_id = 2002
+    sheet = FakeSheet([
+        ["Tanggal", "Modal", "Harga", "BTC"],
+        ["2024-01-01 00:00:00", "100000", "500000000", "0.0002"],
+        ["2024-01-02", "200000", "500000000", "0.0004"],   # diketik manual, belum ada di ledger lokal
+    ])
+    monkeypatch.setattr(bot, "sync_ledger", lambda *args, **kwargs: None)
+    monkeypatch.setattr(bot, "setup_google_sheets", lambda chat_id: sheet)
+    monkeypatch.setattr(bot, "with_sheet", lambda chat_id, operation: operation(sheet))
+    bot._store_ledger_rows(chat_id, [(2, "2024-01-01 00:00:00", 100000.0, 500000000.0, 0.0002)])
+
+    bot.record_deposits(chat_id, [("2024-01-03 00:00:00", 300000.0, 500000000.0, 0.0006)])
+
+    assert [row[0] for row in bot.load_ledger_rows(chat_id)] == ["2024-01-01 00:00:00", "2024-01-02", "2024-01-03 00:00:00"]
+    totals = bot.get_ledger_totals(chat_id)
+    assert totals["jumlah_deposit"] == 3
+    assert totals["total_modal"] == pytest.approx(600000.0)
+
+
+def test_record_deposits_resets_client_after_transport_error(monkeypatch):
+    class BrokenSheet:
+        calls = 0
+
+        def append_rows(self, rows):
+            BrokenSheet.calls += 1
+            raise bot.requests.exceptions.ConnectionError("connection reset")
+
+    resets = []
+    monkeypatch.setattr(bot, "sync_ledger", lambda *args, **kwargs: None)
+    monkeypatch.setattr(bot, "setup_google_sheets", lambda chat_id: BrokenSheet())
+    monkeypatch.setattr(bot, "reset_google_sheets", lambda: resets.append(True))
+
+    with pytest.raises(bot.requests.exceptions.ConnectionError):
+        bot.record_deposits(2003, [("2024-01-03 00:00:00", 300000.0, 500000000.0, 0.0006)])
+    # Tidak diulang (hindari deposit ganda), tetapi klien yang rusak dibuang
+    assert BrokenSheet.calls == 1
+    assert resets == [True]